@@ -53,6 +53,9 @@ async def test_project_similarity(tokenization_service: TokenizationService = De
         game_all_source = ""
         calc_file_details = []
         game_file_details = []
+        # Content and tokens of every file, reused by the file-by-file analysis
+        calc_file_sources = []
+        game_file_sources = []
 
         for file_path in calc_files:
             with open(file_path, "r", encoding="utf-8") as f:
@@ -60,6 +63,7 @@ async def test_project_similarity(tokenization_service: TokenizationService = De
             tokens = tokenization_service.tokenize(content, file_path)
             calc_all_tokens.extend(tokens)
             calc_all_source += f"\n# === {file_path.name} ===\n" + content + "\n"
+            calc_file_sources.append((file_path, content, tokens))
             calc_file_details.append(
                 {"filename": file_path.name, "tokens": len(tokens), "lines": len(content.splitlines())}
             )
@@ -70,6 +74,7 @@ async def test_project_similarity(tokenization_service: TokenizationService = De
             tokens = tokenization_service.tokenize(content, file_path)
             game_all_tokens.extend(tokens)
             game_all_source += f"\n# === {file_path.name} ===\n" + content + "\n"
+            game_file_sources.append((file_path, content, tokens))
             game_file_details.append(
                 {"filename": file_path.name, "tokens": len(tokens), "lines": len(content.splitlines())}
             )
@@ -86,19 +91,20 @@ async def test_project_similarity(tokenization_service: TokenizationService = De
             tokenization_service=tokenization_service,
         )
 
-        # File-by-file analysis
-        file_comparisons = []
-        for calc_file in calc_files:
-            with open(calc_file, "r", encoding="utf-8") as f:
-                calc_content = f.read()
-            calc_tokens = tokenization_service.tokenize(calc_content, calc_file)
+        # File-by-file analysis, each file is profiled and prepared once for all of its comparisons
+        game_file_data = []
+        for game_file, game_content, game_tokens in game_file_sources:
+            game_profile = similarity_service.profile_tokens(game_tokens)
+            game_prepared = similarity_service.prepare_file(game_content, game_file, tokenization_service)
+            game_file_data.append((game_file, game_content, game_profile, game_prepared))
 
-            for game_file in game_files:
-                with open(game_file, "r", encoding="utf-8") as f:
-                    game_content = f.read()
-                game_tokens = tokenization_service.tokenize(game_content, game_file)
+        file_comparisons = []
+        for calc_file, calc_content, calc_tokens in calc_file_sources:
+            calc_profile = similarity_service.profile_tokens(calc_tokens)
+            calc_prepared = similarity_service.prepare_file(calc_content, calc_file, tokenization_service)
 
-                file_similarity = similarity_service.compare_similarity(calc_tokens, game_tokens)
+            for game_file, game_content, game_profile, game_prepared in game_file_data:
+                file_similarity = similarity_service.compare_similarity(calc_profile, game_profile)
                 file_shared = similarity_service.detect_shared_code_blocks(
                     source1=calc_content,
                     source2=game_content,
@@ -107,6 +113,8 @@ async def test_project_similarity(tokenization_service: TokenizationService = De
                     file1_path=calc_file,
                     file2_path=game_file,
                     tokenization_service=tokenization_service,
+                    prepared1=calc_prepared,
+                    prepared2=game_prepared,
                 )
 
                 file_comparisons.append(
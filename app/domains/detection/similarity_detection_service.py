@@ -5,19 +5,211 @@ Handles code similarity analysis, comparison, and shared code block detection.
 
 import logging
 import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
 from difflib import SequenceMatcher
+from hashlib import blake2b
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, FrozenSet, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of function pair comparisons kept in the comparison cache
+_PAIR_CACHE_SIZE = 4096
+
+# Bit position of each token type seen so far, type sets of functions are also kept as masks of these bits
+_TYPE_BITS: Dict[str, int] = {}
+_TYPE_BITS_LOCK = threading.Lock()
+
+# Token types normalized to generic placeholders for similarity comparison
+_NORMALIZED_TYPES = {
+    "string": "<STRING>",
+    "integer": "<NUMBER>",
+    "float": "<NUMBER>",
+    "identifier": "<VAR>",
+    "comment": "<COMMENT>",
+}
+
+# Token types filtered out of similarity comparison
+_SKIP_TYPES = frozenset(["comment", "ERROR"])  # Parsing errors
+
+# Structural element of each token type, similar concepts share an element; other types map to their upper case
+_STRUCTURAL_ELEMENTS = {
+    "function_definition": "FUNC_DEF",
+    "method_definition": "FUNC_DEF",
+    "if_statement": "CONDITIONAL",
+    "elif_clause": "CONDITIONAL",
+    "else_clause": "ELSE",
+    "for_statement": "LOOP",
+    "while_statement": "LOOP",
+    "return_statement": "RETURN",
+    "assignment": "ASSIGN",
+    "augmented_assignment": "ASSIGN",
+    "binary_operator": "OPERATOR",
+    "unary_operator": "OPERATOR",
+    "call": "CALL",
+    "list": "COLLECTION",
+    "tuple": "COLLECTION",
+    "dictionary": "COLLECTION",
+    "set": "COLLECTION",
+    "string": "LITERAL",
+    "integer": "LITERAL",
+    "float": "LITERAL",
+    "identifier": "VAR",
+}
+
+# Structural element of every token type met so far, one shared string per element so that sequences stay compact
+# and compare by identity; completed from _STRUCTURAL_ELEMENTS on first sight of a type
+_STRUCTURAL_ELEMENT_CACHE: Dict[str, str] = dict(_STRUCTURAL_ELEMENTS)
+
+# Pattern and replacement normalizing the text of structural tokens, per token type
+_CONDITION_NORMALIZATION = (re.compile(r"(if|elif)\s+.+:"), r"\1 condition:")
+_STRUCTURAL_TOKEN_NORMALIZATIONS = {
+    # "def calculate_area(radius):" -> "def func(params):"
+    "function_definition": (re.compile(r"def\s+\w+\([^)]*\):"), "def func(params):"),
+    # "def __init__(self, name):" -> "def method(self, params):"
+    "method_definition": (re.compile(r"def\s+\w+\(self[^)]*\):"), "def method(self, params):"),
+    # "class Person:" -> "class Class:"
+    "class_definition": (re.compile(r"class\s+\w+:"), "class Class:"),
+    # "result = calculate(x, y)" -> "var = expr"
+    "assignment": (re.compile(r"\w+\s*=\s*.+"), "var = expr"),
+    # "if x > 0:" -> "if condition:"
+    "if_statement": _CONDITION_NORMALIZATION,
+    "elif_clause": _CONDITION_NORMALIZATION,
+    # "for i in range(10):" -> "for item in iterable:"
+    "for_statement": (re.compile(r"for\s+\w+\s+in\s+.+:"), "for item in iterable:"),
+    "while_statement": (re.compile(r"while\s+.+:"), "while condition:"),
+    # "calculate(x, y)" -> "func(args)"
+    "call": (re.compile(r"\w+\([^)]*\)"), "func(args)"),
+}
+
+# Operation category of each operator text; operators missing from the table are "OPERATOR"
+_PYTHON_OPERATOR_CATEGORIES = {
+    **dict.fromkeys(["+", "-", "*", "/", "//", "%", "**"], "MATH_OP"),
+    **dict.fromkeys(["==", "!=", "<", ">", "<=", ">="], "COMPARE_OP"),
+    **dict.fromkeys(["and", "or", "not"], "LOGIC_OP"),
+}
+_JAVA_OPERATOR_CATEGORIES = {
+    **dict.fromkeys(["+", "-", "*", "/", "%"], "MATH_OP"),
+    **dict.fromkeys(["==", "!=", "<", ">", "<=", ">="], "COMPARE_OP"),
+    **dict.fromkeys(["&&", "||", "!"], "LOGIC_OP"),
+}
+
+# Operator token types mapped to the categories of their language family
+_OPERATOR_CATEGORIES = {
+    # Python/JavaScript patterns
+    **dict.fromkeys(
+        ["binary_operator", "unary_operator", "comparison_operator", "boolean_operator", "augmented_assignment"],
+        _PYTHON_OPERATOR_CATEGORIES,
+    ),
+    # Java patterns
+    **dict.fromkeys(
+        [
+            "binary_expression",
+            "unary_expression",
+            "assignment_expression",
+            "update_expression",
+            "conditional_expression",
+        ],
+        _JAVA_OPERATOR_CATEGORIES,
+    ),
+}
+
+# Control flow token types, kept as is in the logical flow
+_FLOW_TYPES = frozenset(
+    [
+        # Python
+        "if_statement",
+        "elif_clause",
+        "else_clause",
+        "for_statement",
+        "while_statement",
+        "break_statement",
+        "continue_statement",
+        "return_statement",
+        "try_statement",
+        "except_clause",
+        "finally_clause",
+        # Java
+        "do_statement",
+        "switch_statement",
+        "case_statement",
+        "catch_clause",
+        "throw_statement",
+        # JavaScript
+        "for_in_statement",
+        "for_of_statement",
+    ]
+)
+
+# Method calls and assignments (common across languages)
+_METHOD_CALL_TYPES = frozenset(["method_invocation", "call", "assignment"])
+
+
+class PreparedTokens(NamedTuple):
+    """Tokens filtered and normalized for similarity comparison, one list per field with an entry per token."""
+
+    types: List[str]
+    texts: List[str]
+    normalized: List[bool]
+
+
+class TokenProfile(NamedTuple):
+    """Per-file similarity artifacts of a token list, computed once and reused for every comparison of the file."""
+
+    tokens: PreparedTokens
+    signature_parts: List[str]
+    signature_part_set: Set[str]
+    type_set: Set[str]
+    structural: List[str]
+    flow: List[str]
+    operations: List[str]
+
+
+class FunctionFeatures(NamedTuple):
+    """Per-function similarity features, computed once and reused for every pairing."""
+
+    digest: bytes
+    length: int
+    structural: List[str]
+    types: List[str]
+    type_set: FrozenSet[str]
+    type_mask: int
+    flow: List[str]
+    operations: List[str]
+    structural_counts: Counter
+    type_counts: Counter
+    flow_counts: Counter
+    operation_counts: Counter
+
+
+class PreparedFile(NamedTuple):
+    """Functions of a file with their tokens and similarity features, built once and reused for every pairing."""
+
+    functions: Dict[str, Dict]
+    tokens: Dict[str, List[Dict[str, Any]]]
+    features: Dict[str, FunctionFeatures]
+
 
 class SimilarityDetectionService:
     def __init__(self):
         """Initialize the similarity detection service."""
-        pass
+        # Function comparisons by feature digests, the same pairs recur across files and requests
+        self._pair_cache: OrderedDict[Tuple[bytes, bytes, Optional[float]], Dict[str, Any]] = OrderedDict()
+        self._pair_cache_lock = threading.Lock()
 
     def prepare_for_similarity(self, tokens: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Prepare tokens for similarity comparison, see _prepare_tokens.
+        Returns one dict per kept token with "type", "text" and "normalized" keys.
+        """
+        return [
+            {"type": token_type, "text": text, "normalized": normalized}
+            for token_type, text, normalized in zip(*self._prepare_tokens(tokens))
+        ]
+
+    def _prepare_tokens(self, tokens: List[Dict[str, Any]]) -> PreparedTokens:
         """
         Prepare tokens for similarity comparison by filtering and normalizing elements.
 
@@ -35,100 +227,82 @@ class SimilarityDetectionService:
         - Numeric literals (normalize to generic placeholder)
         - Variable names (normalize to generic placeholder)
         """
-        similarity_tokens = []
-
-        # Types to keep as-is (structural/logical elements)
-        keep_types = {
-            "if_statement",
-            "else_clause",
-            "elif_clause",
-            "for_statement",
-            "while_statement",
-            "break_statement",
-            "continue_statement",
-            "function_definition",
-            "class_definition",
-            "method_definition",
-            "call",
-            "attribute",
-            "subscript",
-            "import_statement",
-            "import_from_statement",
-            "return_statement",
-            "yield_statement",
-            "try_statement",
-            "except_clause",
-            "finally_clause",
-            "with_statement",
-            "assert_statement",
-            "list",
-            "dictionary",
-            "set",
-            "tuple",
-            "list_comprehension",
-            "dictionary_comprehension",
-            "set_comprehension",
-            "lambda",
-            "generator_expression",
-            "binary_operator",
-            "unary_operator",
-            "comparison_operator",
-            "boolean_operator",
-            "assignment",
-            "augmented_assignment",
-            "decorated_definition",
-        }
-
-        # Types normalized to generic placeholders
-        normalize_types = {
-            "string": "<STRING>",
-            "integer": "<NUMBER>",
-            "float": "<NUMBER>",
-            "identifier": "<VAR>",
-            "comment": "<COMMENT>",
-        }
-
-        # Types to completely filter out
-        skip_types = {"comment", "ERROR"}  # Parsing errors
+        types = []
+        texts = []
+        normalized = []
+        append_type = types.append
+        append_text = texts.append
+        append_normalized = normalized.append
 
         for token in tokens:
             token_type = token.get("type", "")
 
             # Skip irrelevant types
-            if token_type in skip_types:
+            if token_type in _SKIP_TYPES:
                 continue
 
-            if token_type in keep_types:
-                similarity_tokens.append({"type": token_type, "text": token.get("text", ""), "normalized": False})
-                continue
+            append_type(token_type)
 
             # Normalize certain types
-            if token_type in normalize_types:
-                similarity_tokens.append({"type": token_type, "text": normalize_types[token_type], "normalized": True})
+            normalized_text = _NORMALIZED_TYPES.get(token_type)
+            if normalized_text is not None:
+                append_text(normalized_text)
+                append_normalized(True)
                 continue
 
-            similarity_tokens.append({"type": token_type, "text": token.get("text", ""), "normalized": False})
+            # Structural/logical elements and every other type are kept as-is
+            append_text(token.get("text", ""))
+            append_normalized(False)
 
-        return similarity_tokens
+        return PreparedTokens(types, texts, normalized)
 
     def get_similarity_signature(self, tokens: List[Dict[str, Any]]) -> str:
         """
         Generate a compact signature for similarity comparison.
         This creates a normalized string representation focusing on structure.
         """
-        similarity_tokens = self.prepare_for_similarity(tokens)
+        return " | ".join(self._signature_parts(self._prepare_tokens(tokens)))
 
+    def _signature_parts(self, similarity_tokens: PreparedTokens) -> List[str]:
+        """
+        Generate the parts of the similarity signature from already prepared tokens.
+        The parts are the ones obtained by splitting the joined signature on " | ".
+        """
         signature_parts = []
-        for token in similarity_tokens:
-            if token["normalized"]:
+        append_part = signature_parts.append
+        normalize_structural_token = self._normalize_structural_token
+        has_separator = False
+        for token_type, text, normalized in zip(*similarity_tokens):
+            if normalized:
                 # For normalized tokens, just use the placeholder
-                signature_parts.append(token["text"])
+                append_part(text)
             else:
                 # For structural tokens, use type + enhanced normalized text
-                token_text = self._normalize_structural_token(token["text"].strip(), token["type"])
+                token_text = normalize_structural_token(text.strip(), token_type)
                 if len(token_text) > 20:
                     token_text = token_text[:20] + "..."
-                signature_parts.append(f"{token['type']}:{token_text}")
+                part = f"{token_type}:{token_text}"
+                # Placeholders never hold the separator, only these parts need checking
+                if "|" in part:
+                    has_separator = True
+                append_part(part)
+
+        # Token text containing the separator splits into more parts
+        if has_separator:
+            return " | ".join(signature_parts).split(" | ")
+
+        return signature_parts
+
+    def _signature_preview(self, signature_parts: List[str], limit: int = 100) -> str:
+        """
+        Return the signature joined from its parts, truncated to limit characters followed by "..." when longer.
+        Only the parts needed to fill the preview are joined.
+        """
+        length = -3
+        for count, part in enumerate(signature_parts, 1):
+            length += 3 + len(part)
+            if length > limit:
+                return " | ".join(signature_parts[:count])[:limit] + "..."
 
         return " | ".join(signature_parts)
 
@@ -136,51 +310,42 @@ class SimilarityDetectionService:
         """
         Enhanced normalization for structural tokens to capture more similarities.
         """
-        if token_type == "function_definition":
-            # Normalize function definitions: "def calculate_area(radius):" -> "def func(params):"
-            return re.sub(r"def\s+\w+\([^)]*\):", "def func(params):", text)
-
-        elif token_type == "method_definition":
-            # Normalize method definitions: "def __init__(self, name):" -> "def method(self, params):"
-            return re.sub(r"def\s+\w+\(self[^)]*\):", "def method(self, params):", text)
-
-        elif token_type == "class_definition":
-            # Normalize class definitions: "class Person:" -> "class Class:"
-            return re.sub(r"class\s+\w+:", "class Class:", text)
+        normalization = _STRUCTURAL_TOKEN_NORMALIZATIONS.get(token_type)
+        if normalization is not None:
+            pattern, replacement = normalization
+            return pattern.sub(replacement, text)
 
-        elif token_type == "return_statement":
+        if token_type == "return_statement":
             # Normalize return statements: "return a + b" -> "return expr"
             if "return" in text and len(text.split()) > 1:
                 return "return expr"
             return text
 
-        elif token_type == "assignment":
-            # Normalize assignments: "result = calculate(x, y)" -> "var = expr"
-            return re.sub(r"\w+\s*=\s*.+", "var = expr", text)
-
-        elif token_type in ["if_statement", "elif_clause"]:
-            # Normalize conditions: "if x > 0:" -> "if condition:"
-            return re.sub(r"(if|elif)\s+.+:", r"\1 condition:", text)
-
-        elif token_type in ["for_statement", "while_statement"]:
-            # Normalize loops: "for i in range(10):" -> "for item in iterable:"
-            if token_type == "for_statement":
-                return re.sub(r"for\s+\w+\s+in\s+.+:", "for item in iterable:", text)
-            else:  # while_statement
-                return re.sub(r"while\s+.+:", "while condition:", text)
-
-        elif token_type == "call":
-            # Normalize function calls: "calculate(x, y)" -> "func(args)"
-            return re.sub(r"\w+\([^)]*\)", "func(args)", text)
-
         # Return original text for other types
         return text
 
-    def _calculate_enhanced_jaccard_similarity(self, sig1_parts: List[str], sig2_parts: List[str]) -> float:
+    def _non_empty_part_set(self, parts: List[str], part_set: Optional[set] = None) -> set:
+        """
+        Return the set of the non-empty signature parts.
+        The precomputed set of all parts is returned unchanged when none of them is blank.
+        """
+        if part_set is not None and all(part.strip() for part in part_set):
+            return part_set
+        return set(part for part in parts if part.strip())
+
+    def _calculate_enhanced_jaccard_similarity(
+        self,
+        sig1_parts: List[str],
+        sig2_parts: List[str],
+        sig1_part_set: Optional[set] = None,
+        sig2_part_set: Optional[set] = None,
+        common_parts: Optional[set] = None,
+    ) -> float:
         """
         Calculate enhanced Jaccard similarity with fuzzy matching for continuous values.
 
         This combines exact matching with fuzzy matching to provide more granular similarity scores.
+        The sets of the signature parts, and their intersection, can be passed when the caller already built them.
         """
         # Early exit for edge cases
         if not sig1_parts and not sig2_parts:
@@ -188,23 +353,23 @@ class SimilarityDetectionService:
         if not sig1_parts or not sig2_parts:
             return 0.0
 
-        # Filter empty parts once
-        sig1_clean = [part for part in sig1_parts if part.strip()]
-        sig2_clean = [part for part in sig2_parts if part.strip()]
+        # Sets of the non-empty parts
+        set1 = self._non_empty_part_set(sig1_parts, sig1_part_set)
+        set2 = self._non_empty_part_set(sig2_parts, sig2_part_set)
 
-        if not sig1_clean and not sig2_clean:
+        if not set1 and not set2:
             return 1.0
-        if not sig1_clean or not sig2_clean:
+        if not set1 or not set2:
             return 0.0
 
-        # Convert to sets for faster operations
-        set1 = set(sig1_clean)
-        set2 = set(sig2_clean)
-
-        # 1. Exact matching (traditional Jaccard)
-        exact_common = set1 & set2
-        total_unique = set1 | set2
-        exact_jaccard = len(exact_common) / len(total_unique)
+        # 1. Exact matching (traditional Jaccard), reusing the caller's intersection when both part sets were reused
+        if common_parts is not None and set1 is sig1_part_set and set2 is sig2_part_set:
+            exact_common = common_parts
+        else:
+            exact_common = set1 & set2
+        # Union size by inclusion-exclusion, without building the union set
+        total_unique_count = len(set1) + len(set2) - len(exact_common)
+        exact_jaccard = len(exact_common) / total_unique_count
 
         # Early exit if perfect match or no potential for fuzzy matching
         if exact_jaccard == 1.0:
@@ -226,23 +391,32 @@ class SimilarityDetectionService:
         unmatched_list1 = list(unmatched_sig1)
         unmatched_list2 = list(unmatched_sig2)
 
+        # One matcher per part of the second signature, it caches its analysis of that part across every part1.
+        # Lengths and character sets of the parts are computed once instead of for every pair
+        candidates2 = [(len(part2), frozenset(part2), SequenceMatcher(None, "", part2)) for part2 in unmatched_list2]
+
         for part1 in unmatched_list1:
             best_match = 0.0
             len1 = len(part1)
+            chars1 = frozenset(part1)
 
-            for part2 in unmatched_list2:
-                len2 = len(part2)
-
-                # Quick length-based filtering (if length difference > 40%, skip)
-                if abs(len1 - len2) / max(len1, len2) > 0.4:
+            for len2, chars2, matcher in candidates2:
+                # Quick length-based filtering (if length difference > 40%, skip), in integers
+                if 5 * abs(len1 - len2) > 2 * max(len1, len2):
                     continue
 
                 # Quick character overlap check before expensive SequenceMatcher
-                if len(set(part1) & set(part2)) / len(set(part1) | set(part2)) < 0.3:
+                common_chars = len(chars1 & chars2)
+                if common_chars / (len(chars1) + len(chars2) - common_chars) < 0.3:
                     continue
 
-                # Use SequenceMatcher only for promising candidates
-                fuzzy_sim = SequenceMatcher(None, part1, part2).ratio()
+                # Use SequenceMatcher only for promising candidates. Its ratio cannot exceed quick_ratio(), a pair
+                # bounded below the threshold or the best match so far cannot change the result
+                matcher.set_seq1(part1)
+                fuzzy_bound = matcher.quick_ratio()
+                if fuzzy_bound < fuzzy_threshold or fuzzy_bound <= best_match:
+                    continue
+                fuzzy_sim = matcher.ratio()
 
                 if fuzzy_sim >= fuzzy_threshold:
                     best_match = max(best_match, fuzzy_sim)
@@ -257,64 +431,91 @@ class SimilarityDetectionService:
         if fuzzy_matches > 0:
             # Calculate fuzzy contribution
             avg_fuzzy = fuzzy_matches / len(unmatched_list1)
-            fuzzy_weight = 0.3 * (len(unmatched_list1) / max(len(sig1_clean), len(sig2_clean)))
+            # Weighted by the number of non-empty parts, duplicates included
+            sig1_clean_count = sum(1 for part in sig1_parts if part.strip())
+            sig2_clean_count = sum(1 for part in sig2_parts if part.strip())
+            fuzzy_weight = 0.3 * (len(unmatched_list1) / max(sig1_clean_count, sig2_clean_count))
             combined_score = exact_jaccard * (1 - fuzzy_weight) + avg_fuzzy * fuzzy_weight
             return min(1.0, combined_score)
 
         return exact_jaccard
 
-    def compare_similarity(self, tokens1: List[Dict[str, Any]], tokens2: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def profile_tokens(self, tokens: List[Dict[str, Any]]) -> TokenProfile:
+        """
+        Prepare a token list and derive the signature, type set and sequences compared by compare_similarity.
+        The profile can be passed to compare_similarity instead of the tokens when a file takes part in many
+        comparisons.
+        """
+        sim_tokens = self._prepare_tokens(tokens)
+
+        # An empty signature still counts as a single empty part
+        signature_parts = self._signature_parts(sim_tokens) or [""]
+        structural, flow, operations = self._extract_sequences(sim_tokens)
+
+        return TokenProfile(
+            tokens=sim_tokens,
+            signature_parts=signature_parts,
+            signature_part_set=set(signature_parts),
+            type_set=set(sim_tokens.types),
+            structural=structural,
+            flow=flow,
+            operations=operations,
+        )
+
+    def compare_similarity(
+        self,
+        tokens1: Union[List[Dict[str, Any]], TokenProfile],
+        tokens2: Union[List[Dict[str, Any]], TokenProfile],
+    ) -> Dict[str, Any]:
         """
-        Compare similarity between two sets of tokens.
+        Compare similarity between two sets of tokens, each given as a token list or as its profile_tokens profile.
         Returns similarity metrics and analysis with overall similarity score.
         """
         # Prepare both token sets for similarity comparison
-        sim_tokens1 = self.prepare_for_similarity(tokens1)
-        sim_tokens2 = self.prepare_for_similarity(tokens2)
+        profile1 = tokens1 if isinstance(tokens1, TokenProfile) else self.profile_tokens(tokens1)
+        profile2 = tokens2 if isinstance(tokens2, TokenProfile) else self.profile_tokens(tokens2)
 
-        # Generate signatures
-        signature1 = self.get_similarity_signature(tokens1)
-        signature2 = self.get_similarity_signature(tokens2)
+        # Signatures
+        sig1_parts, sig2_parts = profile1.signature_parts, profile2.signature_parts
+        sig1_part_set, sig2_part_set = profile1.signature_part_set, profile2.signature_part_set
 
-        sig1_parts = signature1.split(" | ")
-        sig2_parts = signature2.split(" | ")
+        # Calculate traditional metrics for backward compatibility
+        common_parts = sig1_part_set & sig2_part_set
 
         # Calculate enhanced Jaccard similarity with fuzzy matching
-        jaccard_similarity = self._calculate_enhanced_jaccard_similarity(sig1_parts, sig2_parts)
+        jaccard_similarity = self._calculate_enhanced_jaccard_similarity(
+            sig1_parts, sig2_parts, sig1_part_set, sig2_part_set, common_parts
+        )
 
-        # Calculate traditional metrics for backward compatibility
-        common_parts = set(sig1_parts) & set(sig2_parts)
-        total_unique_parts = set(sig1_parts) | set(sig2_parts)
+        total_unique_parts_count = len(sig1_part_set) + len(sig2_part_set) - len(common_parts)
 
         # Structure similarity (focusing on types only)
-        types1 = [token["type"] for token in sim_tokens1]
-        types2 = [token["type"] for token in sim_tokens2]
+        types1 = profile1.tokens.types
+        types2 = profile2.tokens.types
 
-        common_types = set(types1) & set(types2)
-        total_types = set(types1) | set(types2)
+        type_set1 = profile1.type_set
+        type_set2 = profile2.type_set
+        common_types = type_set1 & type_set2
+        total_types_count = len(type_set1) + len(type_set2) - len(common_types)
 
-        type_similarity = len(common_types) / len(total_types) if total_types else 0
+        type_similarity = len(common_types) / total_types_count if total_types_count else 0
 
         # 1. STRUCTURAL SEQUENCE SIMILARITY
-        seq1 = self._create_structural_sequence(sim_tokens1)
-        seq2 = self._create_structural_sequence(sim_tokens2)
+        seq1, flow1, ops1 = profile1.structural, profile1.flow, profile1.operations
+        seq2, flow2, ops2 = profile2.structural, profile2.flow, profile2.operations
         structural_similarity = self._sequence_similarity_optimized(seq1, seq2)
 
         # 2. TOKEN TYPE SEQUENCE SIMILARITY
         type_sequence_similarity = self._sequence_similarity_optimized(types1, types2)
 
         # 3. LOGICAL FLOW SIMILARITY (if-else, loops, returns)
-        flow1 = self._extract_logical_flow(sim_tokens1)
-        flow2 = self._extract_logical_flow(sim_tokens2)
         flow_similarity = self._sequence_similarity_optimized(flow1, flow2)
 
         # 4. OPERATION SIMILARITY
-        ops1 = self._extract_operations(sim_tokens1)
-        ops2 = self._extract_operations(sim_tokens2)
         operation_similarity = self._sequence_similarity_optimized(ops1, ops2)
 
         # 5. LENGTH PENALTY for very different file sizes
-        len1, len2 = len(sim_tokens1), len(sim_tokens2)
+        len1, len2 = len(types1), len(types2)
         length_ratio = min(len1, len2) / max(len1, len2) if max(len1, len2) > 0 else 0.0
         length_penalty = 1.0 if length_ratio > 0.5 else (0.9 if length_ratio > 0.3 else 0.8)
 
@@ -336,13 +537,9 @@ class SimilarityDetectionService:
         if type_sequence_similarity == 0.0 and (len(types1) > 1000 or len(types2) > 1000):
             skipped_metrics.append("type_sequence")
         if flow_similarity == 0.0:
-            flow1 = self._extract_logical_flow(sim_tokens1)
-            flow2 = self._extract_logical_flow(sim_tokens2)
             if len(flow1) > 1000 or len(flow2) > 1000:
                 skipped_metrics.append("flow")
         if operation_similarity == 0.0:
-            ops1 = self._extract_operations(sim_tokens1)
-            ops2 = self._extract_operations(sim_tokens2)
             if len(ops1) > 1000 or len(ops2) > 1000:
                 skipped_metrics.append("operation")
 
@@ -375,7 +572,7 @@ class SimilarityDetectionService:
             "operation_similarity": round(operation_similarity, 4),
             "length_penalty": round(length_penalty, 4),
             "common_elements": len(common_parts),
-            "total_unique_elements": len(total_unique_parts),
+            "total_unique_elements": total_unique_parts_count,
             "signature1_length": len(sig1_parts),
             "signature2_length": len(sig2_parts),
             "tokens1_length": len1,
@@ -383,8 +580,8 @@ class SimilarityDetectionService:
             "length_ratio": round(length_ratio, 4),
             "common_types": list(common_types),
             "signatures": {
-                "file1": signature1[:100] + "..." if len(signature1) > 100 else signature1,
-                "file2": signature2[:100] + "..." if len(signature2) > 100 else signature2,
+                "file1": self._signature_preview(sig1_parts),
+                "file2": self._signature_preview(sig2_parts),
             },
         }
 
@@ -397,6 +594,10 @@ class SimilarityDetectionService:
         file1_path: Path = None,
         file2_path: Path = None,
         tokenization_service=None,
+        functions1: Optional[Dict[str, Dict]] = None,
+        functions2: Optional[Dict[str, Dict]] = None,
+        prepared1: Optional[PreparedFile] = None,
+        prepared2: Optional[PreparedFile] = None,
     ) -> Dict[str, Any]:
         """
         Detect shared code blocks between two source files using Tree-sitter queries.
@@ -409,6 +610,10 @@ class SimilarityDetectionService:
             file1_path: Path object for first file (for language detection)
             file2_path: Path object for second file (for language detection)
             tokenization_service: Instance of TokenizationService for function extraction
+            functions1: Functions already extracted from source1, skips re-extraction when provided
+            functions2: Functions already extracted from source2, skips re-extraction when provided
+            prepared1: First file already prepared with prepare_file, skips extraction and tokenization when provided
+            prepared2: Second file already prepared with prepare_file, skips extraction and tokenization when provided
         """
         if not tokenization_service:
             logger.warning("No tokenization service provided, cannot extract functions")
@@ -421,84 +626,43 @@ class SimilarityDetectionService:
                 "shared_percentage": 0.0,
             }
 
-        # Extract functions from both files using the improved tokenization service
-        functions1 = tokenization_service.extract_functions_with_positions(source1, file1_path)
-        functions2 = tokenization_service.extract_functions_with_positions(source2, file2_path)
+        # Extract and tokenize the functions of both files, unless the caller prepared them already
+        if prepared1 is None:
+            prepared1 = self.prepare_file(source1, file1_path, tokenization_service, functions1)
+        if prepared2 is None:
+            prepared2 = self.prepare_file(source2, file2_path, tokenization_service, functions2)
+        functions1, functions2 = prepared1.functions, prepared2.functions
 
         logger.info(f"Extracted {len(functions1)} functions from {file1_name}")
         logger.info(f"Extracted {len(functions2)} functions from {file2_name}")
-
-        # PRE-TOKENIZE ALL FUNCTIONS ONCE to avoid repeated tokenization calls
         logger.debug(
-            f"Pre-tokenizing {len(functions1)} functions from file1 and {len(functions2)} functions from file2"
+            f"Starting {len(functions1)} × {len(functions2)} = {len(functions1) * len(functions2)} function comparisons"
         )
 
-        # Tokenize all functions from file1 once
-        func1_tokens_cache = {}
-        for func1_id, func1_data in functions1.items():
-            func1_tokens = tokenization_service.tokenize(func1_data["code_block"], file1_path)
-            func1_tokens_cache[func1_id] = func1_tokens
-
-        # Tokenize all functions from file2 once
-        func2_tokens_cache = {}
-        for func2_id, func2_data in functions2.items():
-            func2_tokens = tokenization_service.tokenize(func2_data["code_block"], file2_path)
-            func2_tokens_cache[func2_id] = func2_tokens
-
-        logger.debug(
-            f"Pre-tokenization complete. Starting {len(functions1)} × {len(functions2)} = {len(functions1) * len(functions2)} function comparisons"
-        )
-
-        # Fast comparison using pre-tokenized data - NO MORE TOKENIZATION CALLS IN LOOP
         shared_blocks = []
         similarity_scores = []
 
-        # Compare all function pairs using pre-tokenized data
-        for func1_id, func1_data in functions1.items():
-            for func2_id, func2_data in functions2.items():
-                # Skip comparison for functions with less than 5 lines (too trivial for meaningful comparison)
-                func1_line_count = func1_data["end_line"] - func1_data["start_line"] + 1
-                func2_line_count = func2_data["end_line"] - func2_data["start_line"] + 1
-
-                if func1_line_count < 5 or func2_line_count < 5:
-                    logger.debug(
-                        f"Skipping comparison of short functions: {func1_data['function_name']} ({func1_line_count} lines) vs {func2_data['function_name']} ({func2_line_count} lines)"
-                    )
-                    continue
-
-                # Use pre-tokenized data - NO TOKENIZATION CALLS HERE
-                func1_tokens = func1_tokens_cache[func1_id]
-                func2_tokens = func2_tokens_cache[func2_id]
-
-                # Compare function similarity
-                func_similarity = self._compare_function_similarity(func1_tokens, func2_tokens)
-
-                logger.debug(
-                    f"Comparing {func1_data['function_name']} with {func2_data['function_name']}: {func_similarity['similarity_score']:.2f}"
-                )
-
-                if func_similarity["similarity_score"] > 0.7:
-
-                    shared_block = {
-                        "file1_function": func1_data["function_name"],
-                        "file2_function": func2_data["function_name"],
-                        "file1_filename": file1_name,
-                        "file2_filename": file2_name,
-                        "similarity_score": func_similarity["similarity_score"],
-                        "common_patterns": func_similarity["common_patterns"],
-                        "file1_code_block": func1_data["code_block"],
-                        "file2_code_block": func2_data["code_block"],
-                        "file1_start_line": func1_data["start_line"],
-                        "file1_end_line": func1_data["end_line"],
-                        "file2_start_line": func2_data["start_line"],
-                        "file2_end_line": func2_data["end_line"],
-                        "file1_language": func1_data.get("language", "unknown"),
-                        "file2_language": func2_data.get("language", "unknown"),
-                        "file1_node_type": func1_data.get("node_type", "unknown"),
-                        "file2_node_type": func2_data.get("node_type", "unknown"),
-                    }
-                    shared_blocks.append(shared_block)
-                    similarity_scores.append(func_similarity["similarity_score"])
+        for func1_data, func2_data, func_similarity in self._similar_function_pairs(prepared1, prepared2, 0.7):
+            shared_block = {
+                "file1_function": func1_data["function_name"],
+                "file2_function": func2_data["function_name"],
+                "file1_filename": file1_name,
+                "file2_filename": file2_name,
+                "similarity_score": func_similarity["similarity_score"],
+                "common_patterns": func_similarity["common_patterns"],
+                "file1_code_block": func1_data["code_block"],
+                "file2_code_block": func2_data["code_block"],
+                "file1_start_line": func1_data["start_line"],
+                "file1_end_line": func1_data["end_line"],
+                "file2_start_line": func2_data["start_line"],
+                "file2_end_line": func2_data["end_line"],
+                "file1_language": func1_data.get("language", "unknown"),
+                "file2_language": func2_data.get("language", "unknown"),
+                "file1_node_type": func1_data.get("node_type", "unknown"),
+                "file2_node_type": func2_data.get("node_type", "unknown"),
+            }
+            shared_blocks.append(shared_block)
+            similarity_scores.append(func_similarity["similarity_score"])
 
         return {
             "shared_blocks": shared_blocks,
@@ -511,6 +675,38 @@ class SimilarityDetectionService:
             ),
         }
 
+    def prepare_file(
+        self,
+        source: str,
+        file_path: Path = None,
+        tokenization_service=None,
+        functions: Optional[Dict[str, Dict]] = None,
+        tokenize_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> PreparedFile:
+        """
+        Extract the functions of a file, tokenize each one and compute its similarity features.
+        The result can be passed to detect_shared_code_blocks for every pairing of the file.
+
+        Args:
+            source: Original source code of the file
+            file_path: Path object for the file (for language detection)
+            tokenization_service: Instance of TokenizationService for function extraction
+            functions: Functions already extracted from source, skips re-extraction when provided
+            tokenize_kwargs: Extra keyword arguments of every tokenize call, such as the tokenization cache context
+        """
+        if functions is None:
+            functions = tokenization_service.extract_functions_with_positions(source, file_path)
+
+        # Tokenize every function once, similarity features only depend on one function
+        tokenize_kwargs = tokenize_kwargs or {}
+        tokens = {
+            func_id: tokenization_service.tokenize(func_data["code_block"], file_path, **tokenize_kwargs)
+            for func_id, func_data in functions.items()
+        }
+        features = {func_id: self._function_features(func_tokens) for func_id, func_tokens in tokens.items()}
+
+        return PreparedFile(functions, tokens, features)
+
     def detect_shared_code_blocks_with_cache(
         self,
         source1: str,
@@ -553,100 +749,47 @@ class SimilarityDetectionService:
                 "shared_percentage": 0.0,
             }
 
-        # Extract functions from both files using cache when context is available
-        if submission1_id and file1_path and project1_root:
-            # Use cached function extraction
-            functions1 = tokenization_service.extract_functions_with_positions(source1, file1_path)
-        else:
-            # Fallback to non-cached
-            functions1 = tokenization_service.extract_functions_with_positions(source1, file1_path)
-
-        if submission2_id and file2_path and project2_root:
-            # Use cached function extraction
-            functions2 = tokenization_service.extract_functions_with_positions(source2, file2_path)
-        else:
-            # Fallback to non-cached
-            functions2 = tokenization_service.extract_functions_with_positions(source2, file2_path)
+        # Tokenize with the cache of each file when its submission context is available
+        prepared1 = self.prepare_file(
+            source1,
+            file1_path,
+            tokenization_service,
+            tokenize_kwargs=self._tokenize_cache_kwargs(submission1_id, file1_path, project1_root),
+        )
+        prepared2 = self.prepare_file(
+            source2,
+            file2_path,
+            tokenization_service,
+            tokenize_kwargs=self._tokenize_cache_kwargs(submission2_id, file2_path, project2_root),
+        )
+        functions1, functions2 = prepared1.functions, prepared2.functions
 
         logger.info(f"Extracted {len(functions1)} functions from {file1_name}")
         logger.info(f"Extracted {len(functions2)} functions from {file2_name}")
-
-        # PRE-TOKENIZE ALL FUNCTIONS ONCE to avoid repeated tokenization calls
-        logger.debug(
-            f"Pre-tokenizing {len(functions1)} functions from file1 and {len(functions2)} functions from file2"
-        )
-
-        # Tokenize all functions from file1 once
-        func1_tokens_cache = {}
-        for func1_id, func1_data in functions1.items():
-            if submission1_id and file1_path and project1_root:
-                func1_tokens = tokenization_service.tokenize(
-                    func1_data["code_block"], file1_path, submission_id=submission1_id, project_root_path=project1_root
-                )
-            else:
-                func1_tokens = tokenization_service.tokenize(func1_data["code_block"], file1_path)
-            func1_tokens_cache[func1_id] = func1_tokens
-
-        # Tokenize all functions from file2 once
-        func2_tokens_cache = {}
-        for func2_id, func2_data in functions2.items():
-            if submission2_id and file2_path and project2_root:
-                func2_tokens = tokenization_service.tokenize(
-                    func2_data["code_block"], file2_path, submission_id=submission2_id, project_root_path=project2_root
-                )
-            else:
-                func2_tokens = tokenization_service.tokenize(func2_data["code_block"], file2_path)
-            func2_tokens_cache[func2_id] = func2_tokens
-
         logger.debug(
             f"Pre-tokenization complete. Starting {len(functions1)} × {len(functions2)} = {len(functions1) * len(functions2)} function comparisons"
         )
 
-        # Fast comparison using pre-tokenized data - NO MORE TOKENIZATION CALLS IN LOOP
         shared_blocks = []
         similarity_scores = []
 
-        # Compare all function pairs using pre-tokenized data
-        for func1_id, func1_data in functions1.items():
-            for func2_id, func2_data in functions2.items():
-                # Skip comparison for functions with less than 5 lines (too trivial for meaningful comparison)
-                func1_line_count = func1_data["end_line"] - func1_data["start_line"] + 1
-                func2_line_count = func2_data["end_line"] - func2_data["start_line"] + 1
-
-                if func1_line_count < 5 or func2_line_count < 5:
-                    logger.debug(
-                        f"Skipping comparison of short functions: {func1_data['function_name']} ({func1_line_count} lines) vs {func2_data['function_name']} ({func2_line_count} lines)"
-                    )
-                    continue
-
-                # Use pre-tokenized data - NO TOKENIZATION CALLS HERE
-                func1_tokens = func1_tokens_cache[func1_id]
-                func2_tokens = func2_tokens_cache[func2_id]
-
-                # Compare function similarity
-                func_similarity = self._compare_function_similarity(func1_tokens, func2_tokens)
-
-                logger.debug(
-                    f"Comparing {func1_data['function_name']} with {func2_data['function_name']}: {func_similarity['similarity_score']:.2f}"
-                )
-
-                # Only consider functions with significant similarity
-                if func_similarity["similarity_score"] > 0.6:  # Threshold for shared blocks
-                    shared_block = {
-                        "file1_function": func1_data["function_name"],
-                        "file2_function": func2_data["function_name"],
-                        "file1_start_line": func1_data["start_line"],
-                        "file1_end_line": func1_data["end_line"],
-                        "file2_start_line": func2_data["start_line"],
-                        "file2_end_line": func2_data["end_line"],
-                        "file1_code_block": func1_data["code_block"],
-                        "file2_code_block": func2_data["code_block"],
-                        "similarity_score": func_similarity["similarity_score"],
-                        "structural_similarity": func_similarity["structural_similarity"],
-                        "common_elements": func_similarity["common_patterns"],
-                    }
-                    shared_blocks.append(shared_block)
-                    similarity_scores.append(func_similarity["similarity_score"])
+        # Only consider functions with significant similarity
+        for func1_data, func2_data, func_similarity in self._similar_function_pairs(prepared1, prepared2, 0.6):
+            shared_block = {
+                "file1_function": func1_data["function_name"],
+                "file2_function": func2_data["function_name"],
+                "file1_start_line": func1_data["start_line"],
+                "file1_end_line": func1_data["end_line"],
+                "file2_start_line": func2_data["start_line"],
+                "file2_end_line": func2_data["end_line"],
+                "file1_code_block": func1_data["code_block"],
+                "file2_code_block": func2_data["code_block"],
+                "similarity_score": func_similarity["similarity_score"],
+                "structural_similarity": func_similarity["structural_similarity"],
+                "common_elements": func_similarity["common_patterns"],
+            }
+            shared_blocks.append(shared_block)
+            similarity_scores.append(func_similarity["similarity_score"])
 
         # Calculate statistics
         total_shared_blocks = len(shared_blocks)
@@ -668,58 +811,213 @@ class SimilarityDetectionService:
         )
         return result
 
+    def _tokenize_cache_kwargs(
+        self, submission_id: Optional[str], file_path: Optional[Path], project_root: Optional[Path]
+    ) -> Dict[str, Any]:
+        """Return the tokenize keyword arguments enabling the tokenization cache, empty without a full context."""
+        if submission_id and file_path and project_root:
+            return {"submission_id": submission_id, "project_root_path": project_root}
+        return {}
+
+    def _similar_function_pairs(
+        self, prepared1: PreparedFile, prepared2: PreparedFile, similarity_threshold: float
+    ) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]]:
+        """
+        Compare the functions of two prepared files and yield (func1_data, func2_data, func_similarity)
+        for every pair scoring above the threshold, in function order.
+        """
+        functions1, func1_tokens_cache, func1_features = prepared1
+        functions2, func2_tokens_cache, func2_features = prepared2
+
+        # Prepared token counts bound the achievable score of a pair.
+        # Only functions worth comparing take part, they are filtered once instead of for every pair
+        func1_lengths = self._comparable_function_lengths(functions1, func1_tokens_cache, func1_features)
+        func2_lengths = self._comparable_function_lengths(functions2, func2_tokens_cache, func2_features)
+
+        # Only pairs with close enough token counts can reach the threshold
+        length_candidates = self._length_candidates(func1_lengths, func2_lengths, similarity_threshold)
+
+        for func1_id, func2_ids in length_candidates.items():
+            # Values of the first function are looked up once for all of its candidates
+            func1_data = functions1[func1_id]
+            func1_length = func1_lengths[func1_id]
+            features1 = func1_features[func1_id]
+
+            for func2_id in func2_ids:
+                func2_data = functions2[func2_id]
+
+                # Skip pairs whose length ratio alone keeps them from reaching the threshold
+                if self._similarity_upper_bound(func1_length, func2_lengths[func2_id]) <= similarity_threshold:
+                    continue
+
+                # Compare function similarity using precomputed features - NO TOKENIZATION CALLS HERE
+                func_similarity = self._compare_function_features_cached(
+                    features1, func2_features[func2_id], min_score=similarity_threshold
+                )
+
+                logger.debug(
+                    f"Comparing {func1_data['function_name']} with {func2_data['function_name']}: {func_similarity['similarity_score']:.2f}"
+                )
+
+                if func_similarity["similarity_score"] > similarity_threshold:
+                    yield func1_data, func2_data, func_similarity
+
     def _compare_function_similarity(
         self, func1_tokens: List[Dict[str, Any]], func2_tokens: List[Dict[str, Any]]
     ) -> Dict[str, Any]:
         """Compare similarity between two function token sequences using improved algorithm."""
         # if not data short circuit to 0
         if not func1_tokens or not func2_tokens or len(func1_tokens) == 0 or len(func2_tokens) == 0:
-            return {
-                "similarity_score": 0.0,
-                "structural_similarity": 0.0,
-                "type_sequence_similarity": 0.0,
-                "type_set_similarity": 0.0,
-                "flow_similarity": 0.0,
-                "operation_similarity": 0.0,
-                "common_patterns": [],
-            }
+            return self._unmatched_function_similarity()
 
-        # Prepare tokens for similarity comparison
-        sim_tokens1 = self.prepare_for_similarity(func1_tokens)
-        sim_tokens2 = self.prepare_for_similarity(func2_tokens)
+        return self._compare_function_features(
+            self._function_features(func1_tokens), self._function_features(func2_tokens)
+        )
 
-        #  STRUCTURAL SEQUENCE SIMILARITY (most important)
-        seq1 = self._create_structural_sequence(sim_tokens1)
-        seq2 = self._create_structural_sequence(sim_tokens2)
+    def _unmatched_function_similarity(self) -> Dict[str, Any]:
+        """Similarity result of a function pair that shares nothing."""
+        return {
+            "similarity_score": 0.0,
+            "structural_similarity": 0.0,
+            "type_sequence_similarity": 0.0,
+            "type_set_similarity": 0.0,
+            "flow_similarity": 0.0,
+            "operation_similarity": 0.0,
+            "common_patterns": [],
+        }
 
-        structural_similarity = self._sequence_similarity_optimized(seq1, seq2)
+    def _function_features(self, tokens: List[Dict[str, Any]]) -> FunctionFeatures:
+        """Compute the similarity features of a single function from its tokens."""
+        sim_tokens = self._prepare_tokens(tokens)
+        types = sim_tokens.types
+        type_counts = Counter(types)
+        structural, flow, operations = self._extract_sequences(sim_tokens)
+
+        return FunctionFeatures(
+            # Every feature derives from the prepared tokens, so equal digests give equal comparisons
+            digest=blake2b(repr(sim_tokens).encode("utf8"), digest_size=16).digest(),
+            length=len(types),
+            structural=structural,
+            types=types,
+            # The distinct types, taken from the counts in first-seen order instead of another pass over the tokens
+            type_set=frozenset(type_counts.keys()),
+            type_mask=self._type_mask(type_counts),
+            flow=flow,
+            operations=operations,
+            structural_counts=Counter(structural),
+            type_counts=type_counts,
+            flow_counts=Counter(flow),
+            operation_counts=Counter(operations),
+        )
 
-        #  TOKEN TYPE PATTERN SIMILARITY
-        types1 = [token["type"] for token in sim_tokens1]
-        types2 = [token["type"] for token in sim_tokens2]
+    def _type_mask(self, types) -> int:
+        """Return the mask with the bit of each of the given token types set, assigning bits to new types."""
+        mask = 0
+        for token_type in types:
+            bit = _TYPE_BITS.get(token_type)
+            if bit is None:
+                with _TYPE_BITS_LOCK:
+                    bit = _TYPE_BITS.setdefault(token_type, len(_TYPE_BITS))
+            mask |= 1 << bit
+        return mask
+
+    def _compare_function_features_cached(
+        self, features1: FunctionFeatures, features2: FunctionFeatures, min_score: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Compare two functions like _compare_function_features, reusing the result of an earlier identical pair.
+        Pairs are kept in order since common_patterns follows the operand order.
+        """
+        key = (features1.digest, features2.digest, min_score)
+        with self._pair_cache_lock:
+            result = self._pair_cache.get(key)
+            if result is not None:
+                self._pair_cache.move_to_end(key)
+
+        if result is None:
+            result = self._compare_function_features(features1, features2, min_score=min_score)
+            with self._pair_cache_lock:
+                self._pair_cache[key] = result
+                if len(self._pair_cache) > _PAIR_CACHE_SIZE:
+                    self._pair_cache.popitem(last=False)
+
+        # Callers store common_patterns in their results, hand out a copy
+        return {**result, "common_patterns": list(result["common_patterns"])}
+
+    def _compare_function_features(
+        self, features1: FunctionFeatures, features2: FunctionFeatures, min_score: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """
+        Compare similarity between two functions from their precomputed features.
 
-        type_sequence_similarity = self._sequence_similarity_optimized(types1, types2)
+        When min_score is given, an upper bound of the score is refined metric by metric, cheapest first,
+        and the pair is reported as unmatched as soon as it provably cannot score above min_score.
+        """
+        seq1, seq2 = features1.structural, features2.structural
+        types1, types2 = features1.types, features2.types
+        flow1, flow2 = features1.flow, features2.flow
+        ops1, ops2 = features1.operations, features2.operations
 
         # Also check set-based type similarity, for different order but same operations
-        common_types = set(types1) & set(types2)
-        total_types = set(types1) | set(types2)
-        type_set_similarity = len(common_types) / len(total_types) if total_types else 0.0
-
-        #  LOGICAL FLOW SIMILARITY (if-else, loops, returns)
-        flow1 = self._extract_logical_flow(sim_tokens1)
-        flow2 = self._extract_logical_flow(sim_tokens2)
-        flow_similarity = self._sequence_similarity_optimized(flow1, flow2)
-
-        #  OPERATION SIMILARITY
-        ops1 = self._extract_operations(sim_tokens1)
-        ops2 = self._extract_operations(sim_tokens2)
-        operation_similarity = self._sequence_similarity_optimized(ops1, ops2)
+        # The shared types are counted on the type masks, the set itself is only built for the full result
+        common_types_count = (features1.type_mask & features2.type_mask).bit_count()
+        total_types_count = len(features1.type_set) + len(features2.type_set) - common_types_count
+        type_set_similarity = common_types_count / total_types_count if total_types_count else 0.0
 
         # Add penalty for very different function lengths
-        len1, len2 = len(sim_tokens1), len(sim_tokens2)
+        len1, len2 = features1.length, features2.length
         length_ratio = min(len1, len2) / max(len1, len2) if max(len1, len2) > 0 else 0.0
         length_penalty = 1.0 if length_ratio > 0.5 else (0.8 if length_ratio > 0.3 else 0.6)
 
+        # Above 1000 tokens skipped metrics get their weight redistributed, the bounds below do not hold
+        prune = min_score is not None and len1 <= 1000 and len2 <= 1000
+        if features1.digest == features2.digest and len1 <= 10000:
+            # Identical prepared tokens (copied code) have identical sequences, none too long to be compared
+            structural_similarity = type_sequence_similarity = flow_similarity = operation_similarity = 1.0
+            if prune:
+                bounds = {"structural": 1.0, "type_sequence": 1.0, "flow": 1.0, "operation": 1.0}
+                if self._bounded_function_score(bounds, type_set_similarity, length_penalty) <= min_score:
+                    return self._unmatched_function_similarity()
+        else:
+            if prune:
+                # A common subsequence cannot use an element more often than it occurs in either sequence
+                bounds = {
+                    "structural": self._histogram_similarity_bound(
+                        features1.structural_counts, features2.structural_counts
+                    ),
+                    "type_sequence": self._histogram_similarity_bound(features1.type_counts, features2.type_counts),
+                    "flow": self._histogram_similarity_bound(features1.flow_counts, features2.flow_counts),
+                    "operation": self._histogram_similarity_bound(
+                        features1.operation_counts, features2.operation_counts
+                    ),
+                }
+                if self._bounded_function_score(bounds, type_set_similarity, length_penalty) <= min_score:
+                    return self._unmatched_function_similarity()
+
+            #  LOGICAL FLOW SIMILARITY (if-else, loops, returns)
+            flow_similarity = self._sequence_similarity_optimized(flow1, flow2)
+            if prune:
+                bounds["flow"] = flow_similarity
+                if self._bounded_function_score(bounds, type_set_similarity, length_penalty) <= min_score:
+                    return self._unmatched_function_similarity()
+
+            #  OPERATION SIMILARITY
+            operation_similarity = self._sequence_similarity_optimized(ops1, ops2)
+            if prune:
+                bounds["operation"] = operation_similarity
+                if self._bounded_function_score(bounds, type_set_similarity, length_penalty) <= min_score:
+                    return self._unmatched_function_similarity()
+
+            #  TOKEN TYPE PATTERN SIMILARITY
+            type_sequence_similarity = self._sequence_similarity_optimized(types1, types2)
+            if prune:
+                bounds["type_sequence"] = type_sequence_similarity
+                if self._bounded_function_score(bounds, type_set_similarity, length_penalty) <= min_score:
+                    return self._unmatched_function_similarity()
+
+            #  STRUCTURAL SEQUENCE SIMILARITY (most important)
+            structural_similarity = self._sequence_similarity_optimized(seq1, seq2)
+
         # Dynamically adjust weights based on available metrics (skip heavy calculations for large functions)
         base_weights = {"structural": 0.4, "type_sequence": 0.25, "flow": 0.2, "operation": 0.1, "type_set": 0.05}
 
@@ -761,146 +1059,164 @@ class SimilarityDetectionService:
             "type_set_similarity": type_set_similarity,
             "flow_similarity": flow_similarity,
             "operation_similarity": operation_similarity,
-            "common_patterns": list(common_types),
+            "common_patterns": list(features1.type_set & features2.type_set),
         }
 
-    def _create_structural_sequence(self, tokens: List[Dict[str, Any]]) -> List[str]:
-        """Create a normalized structural sequence from tokens."""
-        sequence = []
-        for token in tokens:
-            token_type = token.get("type", "")
+    def _bounded_function_score(
+        self, sequence_bounds: Dict[str, float], type_set_similarity: float, length_penalty: float
+    ) -> float:
+        """
+        Upper bound of the function similarity score given upper bounds of its sequence metrics.
+        Uses the weights and evaluation order of _compare_function_features, so rounding cannot break the bound.
+        """
+        return (
+            sequence_bounds["structural"] * 0.4
+            + sequence_bounds["type_sequence"] * 0.25
+            + sequence_bounds["flow"] * 0.2
+            + sequence_bounds["operation"] * 0.1
+            + type_set_similarity * 0.05
+        ) * length_penalty
+
+    def _histogram_similarity_bound(self, counts1: Counter, counts2: Counter) -> float:
+        """Upper bound of _sequence_similarity for sequences with the given element counts."""
+        length1, length2 = counts1.total(), counts2.total()
+        if not length1 and not length2:
+            return 1.0
+        if not length1 or not length2:
+            return 0.0
 
-            # Map similar concepts to same structural element
-            if token_type in ["function_definition", "method_definition"]:
-                sequence.append("FUNC_DEF")
-            elif token_type in ["if_statement", "elif_clause"]:
-                sequence.append("CONDITIONAL")
-            elif token_type == "else_clause":
-                sequence.append("ELSE")
-            elif token_type in ["for_statement", "while_statement"]:
-                sequence.append("LOOP")
-            elif token_type == "return_statement":
-                sequence.append("RETURN")
-            elif token_type in ["assignment", "augmented_assignment"]:
-                sequence.append("ASSIGN")
-            elif token_type in ["binary_operator", "unary_operator"]:
-                sequence.append("OPERATOR")
-            elif token_type in ["call"]:
-                sequence.append("CALL")
-            elif token_type in ["list", "tuple", "dictionary", "set"]:
-                sequence.append("COLLECTION")
-            elif token_type in ["string", "integer", "float"]:
-                sequence.append("LITERAL")
-            elif token_type == "identifier":
-                sequence.append("VAR")
-            else:
-                sequence.append(token_type.upper())
+        if len(counts1) > len(counts2):
+            counts1, counts2 = counts2, counts1
+        overlap = sum(min(count, counts2[element]) for element, count in counts1.items())
+        return overlap / max(length1, length2)
+
+    def _similarity_upper_bound(self, length1: int, length2: int) -> float:
+        """
+        Upper bound of _compare_function_similarity for functions with the given prepared token counts.
+
+        The structural and type sequences hold one element per prepared token, so their LCS ratio cannot
+        exceed the length ratio; the remaining metrics are bounded by 1.0. The bound is slightly inflated
+        to absorb floating point rounding.
+        """
+        max_length = max(length1, length2)
+        if max_length == 0:
+            # Empty sequences compare as identical, only the length penalty applies
+            return 0.6 + 1e-9
+
+        length_ratio = min(length1, length2) / max_length
+        length_penalty = 1.0 if length_ratio > 0.5 else (0.8 if length_ratio > 0.3 else 0.6)
+
+        if max_length > 1000:
+            # Skipped heavy metrics have their weight redistributed, so only the penalty is a safe bound
+            return length_penalty + 1e-9
+
+        return length_penalty * (0.65 * length_ratio + 0.35) + 1e-9
+
+    def _comparable_function_lengths(
+        self, functions: Dict[str, Dict], tokens_cache: Dict[str, List], features: Dict[str, FunctionFeatures]
+    ) -> Dict[str, int]:
+        """
+        Map the functions worth comparing to their prepared token count, in their original order.
+        Functions with less than 5 lines are too trivial for meaningful comparison, and functions without tokens
+        never share code.
+        """
+        lengths = {}
+        for func_id, func_data in functions.items():
+            line_count = func_data["end_line"] - func_data["start_line"] + 1
+            if line_count < 5:
+                logger.debug(
+                    f"Skipping comparison of short function: {func_data['function_name']} ({line_count} lines)"
+                )
+                continue
+            if tokens_cache[func_id]:
+                lengths[func_id] = features[func_id].length
+
+        return lengths
+
+    def _length_candidates(
+        self, lengths1: Dict[str, int], lengths2: Dict[str, int], similarity_threshold: float
+    ) -> Dict[str, List[str]]:
+        """
+        Map each function of the first file to the functions of the second file, in their original order,
+        whose prepared token count is close enough for _similarity_upper_bound to possibly exceed the threshold.
+        """
+        # Smallest length ratio whose length penalty (see _similarity_upper_bound) can still exceed the threshold
+        if similarity_threshold < 0.6 + 1e-9:
+            return {func1_id: list(lengths2) for func1_id in lengths1}
+        if similarity_threshold < 0.8 + 1e-9:
+            ratio_floor = 0.3
+        elif similarity_threshold < 1.0 + 1e-9:
+            ratio_floor = 0.5
+        else:
+            return {func1_id: [] for func1_id in lengths1}
 
-        return sequence
+        func2_ids = list(lengths2)
+        by_length = sorted(range(len(func2_ids)), key=lambda index: lengths2[func2_ids[index]])
+        sorted_lengths = [lengths2[func2_ids[index]] for index in by_length]
+
+        candidates = {}
+        for func1_id, length1 in lengths1.items():
+            # Slightly widened window, pairs near its edges are settled by _similarity_upper_bound
+            low = bisect_left(sorted_lengths, length1 * ratio_floor * (1 - 1e-9))
+            high = bisect_right(sorted_lengths, length1 / ratio_floor * (1 + 1e-9))
+            candidates[func1_id] = [func2_ids[index] for index in sorted(by_length[low:high])]
+
+        return candidates
+
+    def _create_structural_sequence(self, tokens: List[Dict[str, Any]]) -> List[str]:
+        """Create a normalized structural sequence from tokens."""
+        return self._extract_sequences(self._as_prepared_tokens(tokens))[0]
 
     # fixme it should use dynamic queries
     def _extract_logical_flow(self, tokens: List[Dict[str, Any]]) -> List[str]:
         """Extract logical flow patterns from tokens (multi-language support)."""
-        flow = []
-        for token in tokens:
-            token_type = token.get("type", "")
-            # Python patterns
-            if token_type in [
-                "if_statement",
-                "elif_clause",
-                "else_clause",
-                "for_statement",
-                "while_statement",
-                "break_statement",
-                "continue_statement",
-                "return_statement",
-                "try_statement",
-                "except_clause",
-                "finally_clause",
-            ]:
-                flow.append(token_type)
-            # Java patterns
-            elif token_type in [
-                "if_statement",
-                "for_statement",
-                "while_statement",
-                "do_statement",
-                "switch_statement",
-                "case_statement",
-                "break_statement",
-                "continue_statement",
-                "return_statement",
-                "try_statement",
-                "catch_clause",
-                "finally_clause",
-                "throw_statement",
-            ]:
-                flow.append(token_type)
-            # JavaScript patterns
-            elif token_type in [
-                "if_statement",
-                "for_statement",
-                "while_statement",
-                "for_in_statement",
-                "for_of_statement",
-                "do_statement",
-                "switch_statement",
-                "case_statement",
-                "break_statement",
-                "continue_statement",
-                "return_statement",
-                "try_statement",
-                "catch_clause",
-                "finally_clause",
-                "throw_statement",
-            ]:
-                flow.append(token_type)
-        return flow
+        return self._extract_sequences(self._as_prepared_tokens(tokens))[1]
 
     def _extract_operations(self, tokens: List[Dict[str, Any]]) -> List[str]:
         """Extract mathematical and logical operations from tokens (multi-language support)."""
+        return self._extract_sequences(self._as_prepared_tokens(tokens))[2]
+
+    def _as_prepared_tokens(self, tokens: List[Dict[str, Any]]) -> PreparedTokens:
+        """Wrap raw token dicts as prepared tokens without filtering them."""
+        return PreparedTokens(
+            [token.get("type", "") for token in tokens],
+            [token.get("text", "") for token in tokens],
+            [False] * len(tokens),
+        )
+
+    def _extract_sequences(self, tokens: PreparedTokens) -> Tuple[List[str], List[str], List[str]]:
+        """
+        Extract the structural sequence, logical flow and operations of prepared tokens in a single pass
+        (multi-language support).
+        """
+        sequence = []
+        flow = []
         operations = []
-        for token in tokens:
-            token_type = token.get("type", "")
-            token_text = token.get("text", "").strip()
-
-            # Python/JavaScript patterns
-            if token_type in [
-                "binary_operator",
-                "unary_operator",
-                "comparison_operator",
-                "boolean_operator",
-                "augmented_assignment",
-            ]:
-                # Normalize common operations
-                if token_text in ["+", "-", "*", "/", "//", "%", "**"]:
-                    operations.append("MATH_OP")
-                elif token_text in ["==", "!=", "<", ">", "<=", ">="]:
-                    operations.append("COMPARE_OP")
-                elif token_text in ["and", "or", "not"]:
-                    operations.append("LOGIC_OP")
-                else:
-                    operations.append("OPERATOR")
-            # Java patterns
-            elif token_type in [
-                "binary_expression",
-                "unary_expression",
-                "assignment_expression",
-                "update_expression",
-                "conditional_expression",
-            ]:
-                if token_text in ["+", "-", "*", "/", "%"]:
-                    operations.append("MATH_OP")
-                elif token_text in ["==", "!=", "<", ">", "<=", ">="]:
-                    operations.append("COMPARE_OP")
-                elif token_text in ["&&", "||", "!"]:
-                    operations.append("LOGIC_OP")
-                else:
-                    operations.append("OPERATOR")
+        append_structural = sequence.append
+        append_flow = flow.append
+        append_operation = operations.append
+        structural_elements = _STRUCTURAL_ELEMENT_CACHE
+
+        for token_type, token_text in zip(tokens.types, tokens.texts):
+            # Map similar concepts to same structural element
+            structural_element = structural_elements.get(token_type)
+            if structural_element is None:
+                structural_element = structural_elements.setdefault(token_type, token_type.upper())
+            append_structural(structural_element)
+
+            # Control flow statements of every supported language
+            if token_type in _FLOW_TYPES:
+                append_flow(token_type)
+
+            # Normalize common operations, per language family
+            operator_categories = _OPERATOR_CATEGORIES.get(token_type)
+            if operator_categories is not None:
+                append_operation(operator_categories.get(token_text.strip(), "OPERATOR"))
             # Method calls and assignments (common across languages)
-            elif token_type in ["method_invocation", "call", "assignment"]:
-                operations.append("METHOD_CALL")
-        return operations
+            elif token_type in _METHOD_CALL_TYPES:
+                append_operation("METHOD_CALL")
+
+        return sequence, flow, operations
 
     def _sequence_similarity(self, seq1: List[str], seq2: List[str]) -> float:
         """Calculate similarity between two sequences using longest common subsequence."""
@@ -911,17 +1227,29 @@ class SimilarityDetectionService:
         if not seq1 or not seq2:
             return 0.0
 
+        # Identical sequences (copied code) are settled by a single C-level comparison
+        if seq1 == seq2:
+            return 1.0
+
+        # The LCS is symmetric, so the shorter sequence takes the masks and keeps the row integers narrow
+        if len(seq1) > len(seq2):
+            seq1, seq2 = seq2, seq1
         m, n = len(seq1), len(seq2)
-        lcs_matrix = [[0] * (n + 1) for _ in range(m + 1)]
 
-        for i in range(1, m + 1):
-            for j in range(1, n + 1):
-                if seq1[i - 1] == seq2[j - 1]:
-                    lcs_matrix[i][j] = lcs_matrix[i - 1][j - 1] + 1
-                else:
-                    lcs_matrix[i][j] = max(lcs_matrix[i - 1][j], lcs_matrix[i][j - 1])
+        # Bit-parallel LCS (Allison-Dix / Hyyro): bit i of a symbol's mask is set where seq1[i] holds that symbol,
+        # and each element of seq2 advances a whole DP row at once through Python's arbitrary-width ints
+        match_masks = {}
+        for i, element in enumerate(seq1):
+            match_masks[element] = match_masks.get(element, 0) | (1 << i)
+
+        full_mask = (1 << m) - 1
+        row = full_mask
+        for element in seq2:
+            matches = row & match_masks.get(element, 0)
+            row = ((row + matches) | (row - matches)) & full_mask
 
-        lcs_length = lcs_matrix[m][n]
+        # Zero bits of the row mark the positions of seq1 consumed by the LCS
+        lcs_length = m - row.bit_count()
         max_length = max(m, n)
 
         # If both sequences are identical and of the same length, return 1.0 (100% similarity)
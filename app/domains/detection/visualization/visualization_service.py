@@ -3,17 +3,34 @@ Visualization Service for generating React Flow compatible AST visualizations.
 Handles conversion of code tokens into interactive graph structures.
 """
 
+import copy
 import logging
 import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from hashlib import blake2b
+from heapq import heappop, heappush
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional
+from weakref import WeakKeyDictionary
 
 logger = logging.getLogger(__name__)
 
+# Import statements, capturing the imported names after "import"
+IMPORT_PATTERN = re.compile(r"^(?:from\s+\S+\s+)?import\s+([^#\n]+)", re.MULTILINE)
+
+# Number of generated visualizations kept for identical source pairs, per tokenization service
+_REACT_FLOW_CACHE_SIZE = 256
+
 
 class VisualizationService:
     """Service for generating React Flow compatible visualizations from code similarity analysis."""
 
+    # Shared by every instance using the same tokenization service, services are created per request
+    _react_flow_caches: "WeakKeyDictionary[Any, OrderedDict[tuple, Dict[str, Any]]]" = WeakKeyDictionary()
+    _react_flow_cache_lock = threading.Lock()
+
     def __init__(self, tokenization_service=None):
         """Initialize the visualization service."""
         if tokenization_service is None:
@@ -34,10 +51,46 @@ class VisualizationService:
     ) -> Dict[str, Any]:
         """
         Generate a React Flow compatible visualization from two sets of tokens.
+        The visualization of an identical source pair is reused from the cache of the tokenization service.
 
         Returns:
             Dictionary containing React Flow nodes and edges for visualization
         """
+        key = (self._source_digest(source1), self._source_digest(source2), file1_name, file2_name, layout_engine)
+        with self._react_flow_cache_lock:
+            cache = self._react_flow_caches.get(self.tokenization_service)
+            result = cache.get(key) if cache is not None else None
+            if result is not None:
+                cache.move_to_end(key)
+
+        if result is None:
+            result = self._build_react_flow_ast(source1, source2, file1_name, file2_name, layout_engine)
+            if "error" in result:
+                # Failures are not cached, they may not happen again
+                return result
+            with self._react_flow_cache_lock:
+                cache = self._react_flow_caches.setdefault(self.tokenization_service, OrderedDict())
+                cache[key] = result
+                if len(cache) > _REACT_FLOW_CACHE_SIZE:
+                    cache.popitem(last=False)
+
+        # Callers adjust nodes and edges in place, hand out a copy
+        return copy.deepcopy(result)
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        """Drop every cached visualization."""
+        with cls._react_flow_cache_lock:
+            cls._react_flow_caches.clear()
+
+    def _source_digest(self, source: str) -> bytes:
+        """Return the digest identifying a source in cache keys."""
+        return blake2b(source.encode("utf8", "surrogatepass"), digest_size=16).digest()
+
+    def _build_react_flow_ast(
+        self, source1: str, source2: str, file1_name: str, file2_name: str, layout_engine: str
+    ) -> Dict[str, Any]:
+        """Generate the React Flow visualization of two sources, see generate_react_flow_ast."""
         try:
             # Import here to avoid circular imports
             from app.domains.detection.similarity_detection_service import SimilarityDetectionService
@@ -50,6 +103,10 @@ class VisualizationService:
             file1_path = Path(file1_name) if file1_name else None
             file2_path = Path(file2_name) if file2_name else None
 
+            # Extract functions once, both detection and node generation reuse them
+            functions1 = self.tokenization_service.extract_functions_with_positions(source1, file1_path)
+            functions2 = self.tokenization_service.extract_functions_with_positions(source2, file2_path)
+
             shared_blocks_result = similarity_service.detect_shared_code_blocks(
                 source1=source1,
                 source2=source2,
@@ -58,6 +115,8 @@ class VisualizationService:
                 file1_path=file1_path,
                 file2_path=file2_path,
                 tokenization_service=self.tokenization_service,
+                functions1=functions1,
+                functions2=functions2,
             )
 
             nodes = []
@@ -65,8 +124,8 @@ class VisualizationService:
             shared_blocks = shared_blocks_result["shared_blocks"]
 
             # Generate nodes and edges for both files
-            file1_functions = self._extract_functions_with_imports(source1, file1_name)
-            file2_functions = self._extract_functions_with_imports(source2, file2_name)
+            file1_functions = self._extract_functions_with_imports(source1, file1_name, functions1)
+            file2_functions = self._extract_functions_with_imports(source2, file2_name, functions2)
 
             # Generate file1 nodes (calculator project)
             file1_nodes = self._generate_file_group_nodes(
@@ -81,25 +140,22 @@ class VisualizationService:
             nodes.extend(file1_nodes)
             nodes.extend(file2_nodes)
 
-            # Generate function call edges within each file
-            file1_call_edges = self._generate_function_call_edges(file1_functions, "file1", source1)
-            file2_call_edges = self._generate_function_call_edges(file2_functions, "file2", source2)
-            edges.extend(file1_call_edges)
-            edges.extend(file2_call_edges)
+            # Generate function call edges within each file, straight into the edge list
+            edges.extend(self._generate_function_call_edges(file1_functions, "file1", source1))
+            edges.extend(self._generate_function_call_edges(file2_functions, "file2", source2))
 
             # Generate similarity edges between files
             similarity_edges = self._generate_similarity_edges_advanced(file1_functions, file2_functions, shared_blocks)
             edges.extend(similarity_edges)
 
-            # Calculate analysis metadata
-            total_similarities = len(
-                [edge for edge in similarity_edges if edge.get("data", {}).get("type") == "similarity"]
-            )
-            average_similarity = sum(
+            # Calculate analysis metadata from the scores of the similarity edges, collected in one pass
+            similarity_scores = [
                 edge.get("data", {}).get("similarity_score", 0)
                 for edge in similarity_edges
                 if edge.get("data", {}).get("type") == "similarity"
-            ) / max(total_similarities, 1)
+            ]
+            total_similarities = len(similarity_scores)
+            average_similarity = sum(similarity_scores) / max(total_similarities, 1)
 
             has_similarity = total_similarities > 0
 
@@ -196,25 +252,22 @@ class VisualizationService:
             nodes.extend(file1_nodes)
             nodes.extend(file2_nodes)
 
-            # Generate function call edges within each file
-            file1_call_edges = self._generate_function_call_edges(file1_functions, "file1", source1)
-            file2_call_edges = self._generate_function_call_edges(file2_functions, "file2", source2)
-            edges.extend(file1_call_edges)
-            edges.extend(file2_call_edges)
+            # Generate function call edges within each file, straight into the edge list
+            edges.extend(self._generate_function_call_edges(file1_functions, "file1", source1))
+            edges.extend(self._generate_function_call_edges(file2_functions, "file2", source2))
 
             # Generate similarity edges between files
             similarity_edges = self._generate_similarity_edges_advanced(file1_functions, file2_functions, shared_blocks)
             edges.extend(similarity_edges)
 
-            # Calculate analysis metadata
-            total_similarities = len(
-                [edge for edge in similarity_edges if edge.get("data", {}).get("type") == "similarity"]
-            )
-            average_similarity = sum(
+            # Calculate analysis metadata from the scores of the similarity edges, collected in one pass
+            similarity_scores = [
                 edge.get("data", {}).get("similarity_score", 0)
                 for edge in similarity_edges
                 if edge.get("data", {}).get("type") == "similarity"
-            ) / max(total_similarities, 1)
+            ]
+            total_similarities = len(similarity_scores)
+            average_similarity = sum(similarity_scores) / max(total_similarities, 1)
 
             has_similarity = total_similarities > 0
 
@@ -239,33 +292,20 @@ class VisualizationService:
             logger.warning(f"Cache-aware visualization failed, falling back to standard method: {e}")
             return self.generate_react_flow_ast(source1, source2, file1_name, file2_name, layout_engine)
 
-    def _extract_functions_with_imports(self, source_code: str, filename: str) -> Dict[str, Any]:
-        """Extract functions and imports from source code."""
+    def _extract_functions_with_imports(
+        self, source_code: str, filename: str, functions_dict: Optional[Dict[str, Dict]] = None
+    ) -> Dict[str, Any]:
+        """Extract functions and imports from source code, reusing already extracted functions when given."""
         if not source_code:
             return {"functions": [], "imports": []}
 
         # Extract functions
-        file_path = Path(filename)
-        functions_dict = self.tokenization_service.extract_functions_with_positions(source_code, file_path)
+        if functions_dict is None:
+            file_path = Path(filename)
+            functions_dict = self.tokenization_service.extract_functions_with_positions(source_code, file_path)
         functions_list = list(functions_dict.values()) if functions_dict else []
 
-        # Extract imports (simple regex-based extraction)
-        imports = []
-        import_lines = re.findall(r"^(?:from\s+\S+\s+)?import\s+([^#\n]+)", source_code, re.MULTILINE)
-        for import_line in import_lines:
-            # Clean up and split imports
-            clean_imports = [imp.strip().split(" as ")[0] for imp in import_line.split(",")]
-            imports.extend([imp.strip() for imp in clean_imports if imp.strip()])
-
-        # Remove duplicates while preserving order
-        unique_imports = []
-        seen = set()
-        for imp in imports:
-            if imp not in seen:
-                unique_imports.append(imp)
-                seen.add(imp)
-
-        return {"functions": functions_list, "imports": unique_imports[:10]}  # Limit to first 10 imports
+        return {"functions": functions_list, "imports": self._extract_imports(source_code)}
 
     def _extract_functions_with_imports_cached(
         self,
@@ -296,23 +336,22 @@ class VisualizationService:
             functions_dict = self.tokenization_service.extract_functions_with_positions(source_code, file_path_obj)
             functions_list = list(functions_dict.values()) if functions_dict else []
 
-        # Extract imports (simple regex-based extraction)
-        imports = []
-        import_lines = re.findall(r"^(?:from\s+\S+\s+)?import\s+([^#\n]+)", source_code, re.MULTILINE)
-        for import_line in import_lines:
-            # Clean up and split imports
-            clean_imports = [imp.strip().split(" as ")[0] for imp in import_line.split(",")]
-            imports.extend([imp.strip() for imp in clean_imports if imp.strip()])
+        return {"functions": functions_list, "imports": self._extract_imports(source_code)}
 
-        # Remove duplicates while preserving order
-        unique_imports = []
-        seen = set()
-        for imp in imports:
-            if imp not in seen:
-                unique_imports.append(imp)
-                seen.add(imp)
+    def _extract_imports(self, source_code: str) -> List[str]:
+        """Extract the first 10 unique imported names from source code (simple regex-based extraction)."""
+        # Unique names in first-seen order
+        imports = {}
+        for import_line in IMPORT_PATTERN.findall(source_code):
+            # Clean up and split imports
+            for imp in import_line.split(","):
+                imp = imp.strip().split(" as ")[0].strip()
+                if imp:
+                    imports[imp] = None
+                    if len(imports) == 10:
+                        return list(imports)
 
-        return {"functions": functions_list, "imports": unique_imports[:10]}  # Limit to first 10 imports
+        return list(imports)
 
     def _generate_file_group_nodes(
         self,
@@ -356,139 +395,228 @@ class VisualizationService:
                 }
             )
 
-        # Function nodes
-        for i, func in enumerate(functions):
-            func_id = f"{file_prefix}_function_{i}_{func['function_name']}"
-
-            # Check for similarity with other file's functions
-            similarity_data = self._find_function_similarity(func, shared_blocks, file_prefix, own_source, other_source)
-
-            # Generate function label with similarity indicator
-            if similarity_data["has_similarity"]:
-                similarity_percent = similarity_data["similarity_score"] * 100
-                label = f"⚡ {func['function_name']} ({similarity_percent:.1f}%)"
-            else:
-                label = f"⚙️ {func['function_name']}"
-
-            func_node = {
-                "id": func_id,
-                "type": "default",
-                "data": {
-                    "label": label,
-                    "type": "function",
-                    "function_name": func["function_name"],
-                    "start_line": func.get("start_line", 0),
-                    "end_line": func.get("end_line", 0),
-                    "has_similarity": similarity_data["has_similarity"],
-                    "similarity_score": similarity_data["similarity_score"],
-                },
-                "parentNode": file_root_id,
-            }
-
-            # Add rich similarity data if found
-            if similarity_data["has_similarity"]:
-                func_node["data"].update(
-                    {
-                        "similarity_target": similarity_data["similarity_target"],
-                        "source_code": similarity_data["source_code"],
-                        "line_numbers": similarity_data["line_numbers"],
-                        "similarity_details": similarity_data["similarity_details"],
-                    }
-                )
-
-            nodes.append(func_node)
+        # Function nodes, shared blocks are indexed once instead of scanned for every function
+        find_similarity = self._find_function_similarity
+        block_index = self._index_shared_blocks(shared_blocks, file_prefix)
+        nodes.extend(
+            self._build_function_node(
+                f"{file_prefix}_function_{i}_{func['function_name']}",
+                func,
+                find_similarity(func, shared_blocks, block_index, file_prefix),
+                file_root_id,
+            )
+            for i, func in enumerate(functions)
+        )
 
         return nodes
 
-    def _find_function_similarity(
-        self, func: Dict[str, Any], shared_blocks: List[Dict], file_prefix: str, own_source: str, other_source: str
+    def _build_function_node(
+        self, func_id: str, func: Dict[str, Any], similarity_data: Dict[str, Any], parent_id: str
     ) -> Dict[str, Any]:
-        """Find similarity data for a function based on shared blocks - returns the HIGHEST similarity match."""
-        best_match = None
-        highest_similarity = 0.0
-
-        for block in shared_blocks:
-            # Check if this function matches a shared block
-            func_matches = False
-            if file_prefix == "file1":
-                func_matches = block.get("file1_function") == func["function_name"] or (
-                    block.get("file1_start_line", 0) <= func.get("start_line", 0) <= block.get("file1_end_line", 0)
-                )
-            else:
-                func_matches = block.get("file2_function") == func["function_name"] or (
-                    block.get("file2_start_line", 0) <= func.get("start_line", 0) <= block.get("file2_end_line", 0)
-                )
+        """Build a function node, with rich similarity data attached when a match was found."""
+        function_name = func["function_name"]
+        has_similarity = similarity_data["has_similarity"]
+        similarity_score = similarity_data["similarity_score"]
+
+        # Generate function label with similarity indicator
+        if has_similarity:
+            label = f"⚡ {function_name} ({similarity_score * 100:.1f}%)"
+        else:
+            label = f"⚙️ {function_name}"
+
+        data = {
+            "label": label,
+            "type": "function",
+            "function_name": function_name,
+            "start_line": func.get("start_line", 0),
+            "end_line": func.get("end_line", 0),
+            "has_similarity": has_similarity,
+            "similarity_score": similarity_score,
+        }
+
+        # Add rich similarity data if found
+        if has_similarity:
+            data["similarity_target"] = similarity_data["similarity_target"]
+            data["source_code"] = similarity_data["source_code"]
+            data["line_numbers"] = similarity_data["line_numbers"]
+            data["similarity_details"] = similarity_data["similarity_details"]
+
+        return {"id": func_id, "type": "default", "data": data, "parentNode": parent_id}
+
+    def _index_shared_blocks(self, shared_blocks: List[Dict], file_prefix: str) -> Dict[str, Any]:
+        """
+        Index the shared blocks of one side for _find_function_similarity. Blocks are ranked by
+        (-similarity_score, position), the best block of a set being the one with the lowest rank.
 
-            if func_matches:
-                current_similarity = block.get("similarity_score", 0.0)
-
-                # Only update if this similarity is higher than the current best
-                if current_similarity > highest_similarity:
-                    highest_similarity = current_similarity
-                    file1_code = block.get("file1_code_block", "")
-                    file2_code = block.get("file2_code_block", "")
-
-                    best_match = {
-                        "has_similarity": True,
-                        "similarity_score": current_similarity,
-                        "similarity_target": f"function_{block.get('file2_function' if file_prefix == 'file1' else 'file1_function', 'unknown')}",
-                        "source_code": {"file1_code": file1_code, "file2_code": file2_code},
-                        "line_numbers": {
-                            "file1": {"start": block.get("file1_start_line", 0), "end": block.get("file1_end_line", 0)},
-                            "file2": {"start": block.get("file2_start_line", 0), "end": block.get("file2_end_line", 0)},
-                        },
-                        "similarity_details": {
-                            "algorithm_used": "ast_similarity_v2",
-                            "similarity_type": "structural",
-                            "confidence_level": current_similarity,
-                            "common_patterns": block.get("common_elements", []),
-                        },
-                    }
+        Returns:
+            Dictionary with the best rank per function name, and the best rank of the blocks covering every
+            line from each breakpoint up to the next one
+        """
+        name_key = f"{file_prefix}_function"
+        start_key = f"{file_prefix}_start_line"
+        end_key = f"{file_prefix}_end_line"
+
+        best_by_name = {}
+        intervals = []
+        for position, block in enumerate(shared_blocks):
+            similarity = block.get("similarity_score", 0.0)
+            # Only blocks above 0.0 can become a function's highest similarity
+            if not similarity > 0.0:
+                continue
+
+            rank = (-similarity, position)
+            name = block.get(name_key)
+            if name not in best_by_name or rank < best_by_name[name]:
+                best_by_name[name] = rank
+
+            start_line, end_line = block.get(start_key, 0), block.get(end_key, 0)
+            if start_line <= end_line:
+                intervals.append((start_line, end_line, rank))
+
+        # The blocks covering a line only change where a block starts or just after one ends
+        breakpoints = sorted({start_line for start_line, _, _ in intervals} | {end + 1 for _, end, _ in intervals})
+        intervals.sort()
+
+        best_from = []
+        covering = []  # Heap of (rank, end_line), blocks that ended are dropped once they reach the top
+        next_interval = 0
+        for line in breakpoints:
+            while next_interval < len(intervals) and intervals[next_interval][0] <= line:
+                _, end_line, rank = intervals[next_interval]
+                heappush(covering, (rank, end_line))
+                next_interval += 1
+            while covering and covering[0][1] < line:
+                heappop(covering)
+            best_from.append(covering[0][0] if covering else None)
+
+        return {"best_by_name": best_by_name, "breakpoints": breakpoints, "best_from": best_from}
 
-        # Return the best match found, or no similarity if none found
-        return best_match if best_match else {"has_similarity": False, "similarity_score": 0}
+    def _find_function_similarity(
+        self, func: Dict[str, Any], shared_blocks: List[Dict], block_index: Dict[str, Any], file_prefix: str
+    ) -> Dict[str, Any]:
+        """
+        Find similarity data for a function based on shared blocks - returns the HIGHEST similarity match.
+        A block matches when it names the function or its line range holds the function's start line; the first
+        of the matching blocks with the highest similarity wins.
+        """
+        rank = block_index["best_by_name"].get(func["function_name"])
+
+        breakpoint_position = bisect_right(block_index["breakpoints"], func.get("start_line", 0)) - 1
+        if breakpoint_position >= 0:
+            in_range = block_index["best_from"][breakpoint_position]
+            if in_range is not None and (rank is None or in_range < rank):
+                rank = in_range
+
+        # Return no similarity if no match was found
+        if rank is None:
+            return {"has_similarity": False, "similarity_score": 0}
+
+        block = shared_blocks[rank[1]]
+        current_similarity = block.get("similarity_score", 0.0)
+        file1_code = block.get("file1_code_block", "")
+        file2_code = block.get("file2_code_block", "")
+
+        return {
+            "has_similarity": True,
+            "similarity_score": current_similarity,
+            "similarity_target": f"function_{block.get('file2_function' if file_prefix == 'file1' else 'file1_function', 'unknown')}",
+            "source_code": {"file1_code": file1_code, "file2_code": file2_code},
+            "line_numbers": {
+                "file1": {"start": block.get("file1_start_line", 0), "end": block.get("file1_end_line", 0)},
+                "file2": {"start": block.get("file2_start_line", 0), "end": block.get("file2_end_line", 0)},
+            },
+            "similarity_details": {
+                "algorithm_used": "ast_similarity_v2",
+                "similarity_type": "structural",
+                "confidence_level": current_similarity,
+                "common_patterns": block.get("common_elements", []),
+            },
+        }
 
     def _generate_function_call_edges(
         self, file_data: Dict[str, Any], file_prefix: str, source_code: str
-    ) -> List[Dict[str, Any]]:
-        """Generate edges representing function calls within a file."""
-        edges = []
+    ) -> Iterator[Dict[str, Any]]:
+        """Generate edges representing function calls within a file, yielded as they are found."""
         functions = file_data.get("functions", [])
 
+        if not functions:
+            return
+
+        # One alternation over all function names, so each body is scanned once instead of once per callee.
+        # Longer names first; identifiers cannot overlap within a match, so every call site is still found.
+        function_names = sorted({func["function_name"] for func in functions}, key=len, reverse=True)
+        call_pattern = re.compile(rf"\b({'|'.join(map(re.escape, function_names))})\s*\(")
+
         # Simple regex-based function call detection
         for i, func in enumerate(functions):
             func_id = f"{file_prefix}_function_{i}_{func['function_name']}"
+            func_code = func.get("code_block", "")
+            start_line = func.get("start_line", 0)
+
+            # Called names mapped to the first line holding a call on its own (None if calls only span lines)
+            call_lines = {}
+            line_num = 0
+            last_pos = 0
+            for match in call_pattern.finditer(func_code):
+                line_num += func_code.count("\n", last_pos, match.start())
+                last_pos = match.start()
+                called_name = match.group(1)
+                if call_lines.get(called_name) is None:
+                    call_lines[called_name] = None if "\n" in match.group(0) else start_line + line_num
+
+            if not call_lines:
+                continue
 
             # Look for calls to other functions in this file
             for j, other_func in enumerate(functions):
-                if i != j:
+                if i != j and other_func["function_name"] in call_lines:
                     other_func_id = f"{file_prefix}_function_{j}_{other_func['function_name']}"
 
-                    # Check if this function calls the other function
-                    func_code = func.get("code_block", "")
-                    call_pattern = rf'\b{re.escape(other_func["function_name"])}\s*\('
-
-                    if re.search(call_pattern, func_code):
-                        # Find approximate line number of the call
-                        call_line = func.get("start_line", 0)
-                        for line_num, line in enumerate(func_code.split("\n")):
-                            if re.search(call_pattern, line):
-                                call_line = func.get("start_line", 0) + line_num
-                                break
-
-                        edges.append(
-                            {
-                                "id": f"call_edge_{func_id}_to_{other_func_id}",
-                                "source": func_id,
-                                "target": other_func_id,
-                                "type": "smoothstep",
-                                "label": "calls",
-                                "animated": True,
-                                "data": {"type": "function_call", "line": call_line},
-                            }
-                        )
+                    # Find approximate line number of the call
+                    call_line = call_lines[other_func["function_name"]]
+                    if call_line is None:
+                        call_line = start_line
+
+                    yield {
+                        "id": f"call_edge_{func_id}_to_{other_func_id}",
+                        "source": func_id,
+                        "target": other_func_id,
+                        "type": "smoothstep",
+                        "label": "calls",
+                        "animated": True,
+                        "data": {"type": "function_call", "line": call_line},
+                    }
 
-        return edges
+    def _index_functions(self, functions: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Index functions by name and by start line for matching them against shared blocks."""
+        first_by_name = {}
+        for i, func in enumerate(functions):
+            first_by_name.setdefault(func["function_name"], i)
+
+        by_start_line = sorted((func.get("start_line", 0), i) for i, func in enumerate(functions))
+        return {
+            "first_by_name": first_by_name,
+            "start_lines": [start_line for start_line, _ in by_start_line],
+            "positions": [i for _, i in by_start_line],
+        }
+
+    def _find_block_function(
+        self, function_index: Dict[str, Any], function_name: Optional[str], start_line: int, end_line: int
+    ) -> Optional[int]:
+        """
+        Return the position of the first function that matches a shared block, either by name or by
+        starting within the block's line range, or None when no function matches.
+        """
+        position = function_index["first_by_name"].get(function_name)
+
+        start_lines = function_index["start_lines"]
+        low = bisect_left(start_lines, start_line)
+        high = bisect_right(start_lines, end_line)
+        if low < high:
+            in_range = min(function_index["positions"][low:high])
+            position = in_range if position is None else min(position, in_range)
+
+        return position
 
     def _generate_similarity_edges_advanced(
         self, file1_data: Dict[str, Any], file2_data: Dict[str, Any], shared_blocks: List[Dict]
@@ -500,26 +628,34 @@ class VisualizationService:
         file1_functions = file1_data.get("functions", [])
         file2_functions = file2_data.get("functions", [])
 
+        # Index functions once instead of scanning them for every block
+        file1_index = self._index_functions(file1_functions)
+        file2_index = self._index_functions(file2_functions)
+
         for block in shared_blocks:
             # Find matching functions
             file1_func_id = None
             file2_func_id = None
 
             # Find file1 function
-            for i, func in enumerate(file1_functions):
-                if func["function_name"] == block.get("file1_function") or (
-                    block.get("file1_start_line", 0) <= func.get("start_line", 0) <= block.get("file1_end_line", 0)
-                ):
-                    file1_func_id = f"file1_function_{i}_{func['function_name']}"
-                    break
+            i = self._find_block_function(
+                file1_index,
+                block.get("file1_function"),
+                block.get("file1_start_line", 0),
+                block.get("file1_end_line", 0),
+            )
+            if i is not None:
+                file1_func_id = f"file1_function_{i}_{file1_functions[i]['function_name']}"
 
             # Find file2 function
-            for i, func in enumerate(file2_functions):
-                if func["function_name"] == block.get("file2_function") or (
-                    block.get("file2_start_line", 0) <= func.get("start_line", 0) <= block.get("file2_end_line", 0)
-                ):
-                    file2_func_id = f"file2_function_{i}_{func['function_name']}"
-                    break
+            i = self._find_block_function(
+                file2_index,
+                block.get("file2_function"),
+                block.get("file2_start_line", 0),
+                block.get("file2_end_line", 0),
+            )
+            if i is not None:
+                file2_func_id = f"file2_function_{i}_{file2_functions[i]['function_name']}"
 
             # Create similarity edge if both functions found
             if file1_func_id and file2_func_id:
@@ -9,7 +9,7 @@ from uuid import UUID
 from fastapi import HTTPException
 from sqlmodel import Session
 
-from app.domains.detection.similarity_detection_service import SimilarityDetectionService
+from app.domains.detection.similarity_detection_service import PreparedFile, SimilarityDetectionService
 from app.domains.detection.visualization import VisualizationService
 from app.domains.repositories.submission_fetcher import SubmissionFetcher, cleanup_temp_directory
 from app.domains.submissions.dto.create_submission_dto import CreateSubmissionDto
@@ -691,6 +691,8 @@ class DetectionIntegrationService:
             file1_path=file1_data["path"],
             file2_path=file2_data["path"],
             tokenization_service=self.tokenization_service,
+            prepared1=self._prepare_processed_file(file1_data),
+            prepared2=self._prepare_processed_file(file2_data),
         )
 
         # Add file context to shared blocks
@@ -702,6 +704,17 @@ class DetectionIntegrationService:
 
         return comparison_result
 
+    def _prepare_processed_file(self, file_data: Dict) -> PreparedFile:
+        """
+        Tokenize the functions of a pre-processed file on its first comparison.
+        A file takes part in many pairs, later comparisons reuse the prepared functions.
+        """
+        if "prepared" not in file_data:
+            file_data["prepared"] = self.similarity_service.prepare_file(
+                file_data["content"], file_data["path"], self.tokenization_service, file_data["functions"]
+            )
+        return file_data["prepared"]
+
     def _calculate_overall_similarity(self, similarity_result: dict, shared_blocks_result: dict) -> float:
         """Calculate overall similarity score combining multiple metrics"""
         jaccard_similarity = similarity_result.get("jaccard_similarity", 0.0)
@@ -22,6 +22,26 @@ from app.shared.exceptions import ValidationException
 
 logger = logging.getLogger(__name__)
 
+# Child node types that hold a function name
+_FUNCTION_NAME_NODE_TYPES = frozenset(
+    ["identifier", "simple_identifier", "name", "property_identifier", "field_identifier"]
+)
+
+# Annotation names picked up as identifiers next to function definitions
+_ANNOTATION_NAMES = frozenset(["Test", "DisplayName", "Override", "Deprecated", "SuppressWarnings"])
+
+# Common constructor names across languages
+_CONSTRUCTOR_NAMES = frozenset(
+    [
+        "__init__",  # Python
+        "__construct",  # PHP
+        "constructor",  # JavaScript/TypeScript
+        "init",  # Some languages use init
+        "initialize",  # Common initialization method
+        "ctor",  # C# abbreviation sometimes used
+    ]
+)
+
 
 class TokenizationService:
     def __init__(self):
@@ -632,6 +652,10 @@ class TokenizationService:
         Returns:
             Dictionary mapping function identifiers to function data
         """
+        # Blank sources hold no functions, skip parsing them
+        if not text or not text.strip():
+            return {}
+
         try:
             # Detect language
             lang_key = self._detect_language(file_path)
@@ -652,8 +676,12 @@ class TokenizationService:
                 logger.warning(f"No parser/language available for {lang_key}")
                 return {}
 
+            # Encode and split the source once, every match slices from the same buffers
+            source_bytes = text.encode("utf8")
+            source_lines = text.split("\n")
+
             # Parse the text
-            tree = parser.parse(bytes(text, "utf8"))
+            tree = parser.parse(source_bytes)
             root_node = tree.root_node
 
             try:
@@ -661,10 +689,9 @@ class TokenizationService:
             except Exception as e:
                 logger.warning(f"Failed to create query for {lang_key}: {e}")
                 # Fallback to simple approach
-                return self._extract_functions_fallback(tree, text, lang_key)
+                return self._extract_functions_fallback(tree, text, lang_key, source_lines, source_bytes)
 
             functions = {}
-            source_lines = text.split("\n")
 
             # Tree-sitter Python API: query.matches() returns a list of tuples
             # Each tuple is (pattern_index, captures_dict) where captures_dict maps capture names to nodes
@@ -691,7 +718,7 @@ class TokenizationService:
                                     end_line = node.end_point[0]
 
                                     # Extract function name from the node
-                                    func_name = self._extract_function_name_from_node(node, text.encode("utf8"))
+                                    func_name = self._extract_function_name_from_node(node, source_bytes)
 
                                     if func_name is None:
                                         # Skip if function name was filtered out (e.g., constructor)
@@ -721,7 +748,7 @@ class TokenizationService:
             # If no functions found with queries, try fallback
             if not functions:
                 logger.debug(f"No functions found with queries, trying fallback for {lang_key}")
-                return self._extract_functions_fallback(tree, text, lang_key)
+                return self._extract_functions_fallback(tree, text, lang_key, source_lines, source_bytes)
 
             logger.debug(
                 f"Successfully extracted {len(functions)} functions from {lang_key} file using Tree-sitter queries"
@@ -732,7 +759,14 @@ class TokenizationService:
             logger.error(f"Function extraction failed for {lang_key}: {e}")
             return {}
 
-    def _extract_functions_fallback(self, tree, text: str, language: str) -> Dict[str, Dict]:
+    def _extract_functions_fallback(
+        self,
+        tree,
+        text: str,
+        language: str,
+        source_lines: Optional[List[str]] = None,
+        source_bytes: Optional[bytes] = None,
+    ) -> Dict[str, Dict]:
         """Fallback function extraction using iterative node traversal to avoid recursion limits"""
         # Skip function extraction for languages that don't have functions
         non_function_languages = {
@@ -755,7 +789,11 @@ class TokenizationService:
             return {}
 
         functions = {}
-        source_lines = text.split("\n")
+        # Reuse the caller's split lines and encoded bytes when available
+        if source_lines is None:
+            source_lines = text.split("\n")
+        if source_bytes is None:
+            source_bytes = text.encode("utf8")
 
         # Common function-related node types across languages
         function_types = {
@@ -787,7 +825,7 @@ class TokenizationService:
                     end_line = node.end_point[0]
 
                     # Try to extract function name
-                    func_name = self._extract_function_name_from_node(node, text.encode("utf8"))
+                    func_name = self._extract_function_name_from_node(node, source_bytes)
                     if func_name is None:
                         # Skip if function name was filtered out (e.g., constructor)
                         continue
@@ -831,50 +869,43 @@ class TokenizationService:
 
     def _extract_function_name_from_node(self, node, source_bytes: bytes) -> Optional[str]:
         """Extract function name from a tree-sitter node"""
-        # Try to find identifier child nodes
-        for child in node.children:
-            if child.type in ["identifier", "simple_identifier", "name", "property_identifier", "field_identifier"]:
+        # Depth-first search over the descendants, one iterator over the children per level of the search
+        levels = [iter(node.children)]
+        while levels:
+            child = next(levels[-1], None)
+            if child is None:
+                levels.pop()
+                continue
+
+            # Try to find identifier child nodes
+            if child.type in _FUNCTION_NAME_NODE_TYPES:
                 try:
                     name = source_bytes[child.start_byte : child.end_byte].decode("utf8")
-                    if name and name.isidentifier():
-                        # Filter out constructor methods as they are typically boilerplate
-                        if self._is_constructor_method(name):
-                            return None
-                        # Filter out annotation names (they start with @ or are common annotation names)
-                        if name.startswith("@") or name in [
-                            "Test",
-                            "DisplayName",
-                            "Override",
-                            "Deprecated",
-                            "SuppressWarnings",
-                        ]:
-                            continue
-                        return name
                 except:
                     continue
+                if name and name.isidentifier():
+                    # Filter out constructor methods as they are typically boilerplate
+                    if self._is_constructor_method(name):
+                        if len(levels) == 1:
+                            return None
+                        # Below the top level a constructor name only ends the search of its subtree
+                        levels.pop()
+                        continue
+                    # Filter out annotation names (they start with @ or are common annotation names)
+                    if name.startswith("@") or name in _ANNOTATION_NAMES:
+                        continue
+                    return name
 
-            # Recursively search in children (limited depth)
+            # Search in the children of this child before its next sibling
             if child.child_count > 0:
-                name = self._extract_function_name_from_node(child, source_bytes)
-                if name:
-                    return name
+                levels.append(iter(child.children))
 
         return None
 
     def _is_constructor_method(self, function_name: str) -> bool:
         """Check if a function name is a constructor method that should be filtered out"""
-        # Common constructor patterns across languages
-        constructor_patterns = {
-            "__init__",  # Python
-            "__construct",  # PHP
-            "constructor",  # JavaScript/TypeScript
-            "init",  # Some languages use init
-            "initialize",  # Common initialization method
-            "ctor",  # C# abbreviation sometimes used
-        }
-
         # Check exact matches
-        if function_name in constructor_patterns:
+        if function_name in _CONSTRUCTOR_NAMES:
             return True
 
         # Check if it's a class name (common constructor pattern in many languages)
@@ -945,7 +976,7 @@ class TokenizationService:
 
             # Check for shebang lines
             if content_lower.startswith("#!"):
-                first_line = content.split("\n")[0].lower()
+                first_line = content.partition("\n")[0].lower()
                 if "python" in first_line:
                     return "python"
                 elif "bash" in first_line or "sh" in first_line:
@@ -1148,13 +1179,14 @@ class TokenizationService:
                 logger.warning(f"No parser available for {lang_key}, skipping tokenization")
                 return []
 
-            # Parse the text
-            tree = parser.parse(bytes(text, "utf8"))
+            # Parse the text, token texts are sliced from the same encoded buffer
+            source_bytes = text.encode("utf8")
+            tree = parser.parse(source_bytes)
             root_node = tree.root_node
 
             # Extract tokens
             tokens = []
-            self._extract_tokens(root_node, text.encode("utf8"), tokens)
+            self._extract_tokens(root_node, source_bytes, tokens)
 
             logger.debug(f"Tokenized {len(tokens)} tokens for language: {lang_key}")
 
@@ -1181,8 +1213,10 @@ class TokenizationService:
             processed_count += 1
 
             # Add current node as token if it has meaningful content and is named
-            if current_node.start_byte < current_node.end_byte and current_node.is_named:
-                token_text = source_code[current_node.start_byte : current_node.end_byte].decode("utf8")
+            start_byte = current_node.start_byte
+            end_byte = current_node.end_byte
+            if start_byte < end_byte and current_node.is_named:
+                token_text = source_code[start_byte:end_byte].decode("utf8")
 
                 token = {
                     "type": current_node.type,
@@ -1208,7 +1242,7 @@ class TokenizationService:
 
         try:
             # concatenate token texts with spaces
-            return " ".join(token.get("text", "") for token in tokens if token.get("text"))
+            return " ".join(text for text in (token.get("text", "") for token in tokens) if text)
 
         except Exception as e:
             logger.error(f"Detokenization failed: {e}")
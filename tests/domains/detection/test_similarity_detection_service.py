@@ -131,6 +131,26 @@ class TestSimilarityDetectionService(unittest.TestCase):
         self.assertEqual(result['jaccard_similarity'], 1.0)
         self.assertEqual(result['type_similarity'], 1.0)
 
+    def test_compare_similarity_with_token_profiles(self):
+        """Test that token profiles compare like the token lists they were built from."""
+        tokens1 = [
+            {'type': 'function_definition', 'text': 'def test():'},
+            {'type': 'identifier', 'text': 'value'},
+            {'type': 'return_statement', 'text': 'return value'}
+        ]
+        tokens2 = [
+            {'type': 'function_definition', 'text': 'def other():'},
+            {'type': 'if_statement', 'text': 'if ready:'},
+            {'type': 'return_statement', 'text': 'return 42'}
+        ]
+
+        profile1 = self.service.profile_tokens(tokens1)
+        profile2 = self.service.profile_tokens(tokens2)
+        expected = self.service.compare_similarity(tokens1, tokens2)
+
+        self.assertEqual(self.service.compare_similarity(profile1, profile2), expected)
+        self.assertEqual(self.service.compare_similarity(tokens1, profile2), expected)
+
     def test_compare_similarity_completely_different(self):
         """Test similarity comparison with completely different tokens."""
         tokens1 = [{'type': 'function_definition', 'text': 'def test1():', 'normalized': False}]
@@ -159,6 +179,36 @@ class TestSimilarityDetectionService(unittest.TestCase):
         self.assertEqual(result['jaccard_similarity'], 0)
         self.assertEqual(result['type_similarity'], 0)
 
+    def test_enhanced_jaccard_similarity_fuzzy_matching(self):
+        """Test that near-identical unmatched parts add a fuzzy contribution weighted by the non-empty parts."""
+        sig1_parts = ['call:foo(a)', 'x', 'x', ' ']
+        sig2_parts = ['call:foo(b)', 'x']
+
+        similarity = self.service._calculate_enhanced_jaccard_similarity(sig1_parts, sig2_parts)
+        with_sets = self.service._calculate_enhanced_jaccard_similarity(
+            sig1_parts, sig2_parts, set(sig1_parts), set(sig2_parts)
+        )
+
+        # exact Jaccard 1/3, fuzzy ratio 10/11 weighted by 0.3 * 1/3 non-empty parts
+        self.assertAlmostEqual(similarity, (1 / 3) * 0.9 + (10 / 11) * 0.1)
+        self.assertEqual(with_sets, similarity)
+
+    def test_compare_similarity_fuzzy_signature_match(self):
+        """Test that compare_similarity scores an inexact signature match through the fuzzy phase."""
+        tokens1 = [
+            {'type': 'import_statement', 'text': 'import os'},
+            {'type': 'import_statement', 'text': 'import sys'},
+        ]
+        tokens2 = [
+            {'type': 'import_statement', 'text': 'import io'},
+            {'type': 'import_statement', 'text': 'import sys'},
+        ]
+
+        result = self.service.compare_similarity(tokens1, tokens2)
+
+        # exact Jaccard 1/3, fuzzy ratio 25/26 weighted by 0.3 * 1/2 non-empty parts
+        self.assertAlmostEqual(result['jaccard_similarity'], (1 / 3) * 0.85 + (25 / 26) * 0.15)
+
     def test_detect_shared_code_blocks_no_functions(self):
         """Test shared code block detection with no functions."""
         tokens1 = [{'type': 'assignment', 'text': 'x = 1', 'normalized': False}]
@@ -230,6 +280,60 @@ class TestSimilarityDetectionService(unittest.TestCase):
 
         self.assertEqual(result['similarity_score'], 0.0)
 
+    def test_compare_function_features_min_score(self):
+        """Test that a minimum score only drops pairs that cannot exceed it."""
+        func1_tokens = [
+            {'type': 'function_definition', 'text': 'def add(a, b):'},
+            {'type': 'if_statement', 'text': 'if a > b:'},
+            {'type': 'return_statement', 'text': 'return a + b'}
+        ]
+        func2_tokens = [
+            {'type': 'class_definition', 'text': 'class Greeter:'},
+            {'type': 'string', 'text': '"hello"'},
+            {'type': 'call', 'text': 'print(name)'},
+            {'type': 'return_statement', 'text': 'return name'}
+        ]
+        features1 = self.service._function_features(func1_tokens)
+        features2 = self.service._function_features(func2_tokens)
+
+        same = self.service._compare_function_features(features1, features1, min_score=0.7)
+        different = self.service._compare_function_features(features1, features2, min_score=0.7)
+
+        self.assertEqual(same['similarity_score'], 1.0)
+        self.assertEqual(different['similarity_score'], 0.0)
+        self.assertGreater(self.service._compare_function_features(features1, features2)['similarity_score'], 0.0)
+
+    def test_function_features_type_mask(self):
+        """Test that type masks share a bit exactly for the shared types."""
+        features1 = self.service._function_features([
+            {'type': 'function_definition', 'text': 'def add(a, b):'},
+            {'type': 'return_statement', 'text': 'return a + b'}
+        ])
+        features2 = self.service._function_features([
+            {'type': 'function_definition', 'text': 'def show(value):'},
+            {'type': 'call', 'text': 'print(value)'}
+        ])
+
+        self.assertEqual(features1.type_mask.bit_count(), len(features1.type_set))
+        self.assertEqual((features1.type_mask & features2.type_mask).bit_count(), 1)
+
+    def test_compare_function_features_cached(self):
+        """Test that repeated function comparisons are served from the cache."""
+        tokens = [
+            {'type': 'function_definition', 'text': 'def add(a, b):'},
+            {'type': 'return_statement', 'text': 'return a + b'}
+        ]
+        features1 = self.service._function_features(tokens)
+        features2 = self.service._function_features(list(tokens))
+
+        first = self.service._compare_function_features_cached(features1, features2)
+        first['common_patterns'].append('mutated')
+        second = self.service._compare_function_features_cached(features2, features1)
+
+        self.assertEqual(features1.digest, features2.digest)
+        self.assertEqual(len(self.service._pair_cache), 1)
+        self.assertEqual(second, self.service._compare_function_features(features1, features2))
+
     def test_create_structural_sequence(self):
         """Test structural sequence creation."""
         tokens = [
@@ -321,6 +425,15 @@ class TestSimilarityDetectionService(unittest.TestCase):
         self.assertEqual(self.service._sequence_similarity(['A'], []), 0.0)
         self.assertEqual(self.service._sequence_similarity([], ['A']), 0.0)
 
+    def test_sequence_similarity_uses_longest_common_subsequence(self):
+        """Test sequence similarity is the LCS length over the longer sequence length."""
+        seq1 = ['A', 'B', 'C', 'B', 'D', 'A', 'B']
+        seq2 = ['B', 'D', 'C', 'A', 'B', 'A']
+
+        similarity = self.service._sequence_similarity(seq1, seq2)
+
+        self.assertAlmostEqual(similarity, 4 / 7)
+
     def test_create_structural_sequence_with_edge_cases(self):
         """Test structural sequence creation with edge case token types."""
         tokens = [
@@ -364,6 +477,21 @@ class TestSimilarityDetectionService(unittest.TestCase):
         self.assertEqual(result[0]['type'], 'some_other_type')
         self.assertFalse(result[0]['normalized'])
 
+    def test_length_candidates_keeps_close_lengths_in_original_order(self):
+        """Test that length candidates drop functions too short or too long to reach the threshold."""
+        lengths1 = {'a': 10}
+        lengths2 = {'long': 40, 'close': 12, 'short': 2, 'same': 10, 'near': 4}
+
+        candidates = self.service._length_candidates(lengths1, lengths2, 0.7)
+
+        self.assertEqual(candidates['a'], ['close', 'same', 'near'])
+
+    def test_length_candidates_low_threshold_keeps_all(self):
+        """Test that a threshold reachable at any length ratio keeps every function."""
+        candidates = self.service._length_candidates({'a': 10}, {'b': 1, 'c': 1000}, 0.5)
+
+        self.assertEqual(candidates['a'], ['b', 'c'])
+
 
 class TestSimilarityDetectionServiceIntegration(unittest.TestCase):
     """Integration tests for SimilarityDetectionService with realistic scenarios."""
@@ -469,5 +597,51 @@ class TestSimilarityDetectionServiceIntegration(unittest.TestCase):
         self.assertEqual(shared_blocks['total_shared_blocks'], 0)
         self.assertEqual(shared_blocks['average_similarity'], 0.0)
 
+    def test_detect_shared_code_blocks_with_prepared_files(self):
+        """Test that prepared files give the same shared blocks without tokenizing again."""
+        tokenization_service = TokenizationService()
+        source1 = "def total(items):\n    result = 0\n    for item in items:\n        result += item\n    return result"
+        source2 = "def summed(values):\n    acc = 0\n    for value in values:\n        acc += value\n    return acc"
+        path1, path2 = Path("file1.py"), Path("file2.py")
+
+        expected = self.service.detect_shared_code_blocks(
+            source1, source2, "file1.py", "file2.py", path1, path2, tokenization_service
+        )
+        prepared1 = self.service.prepare_file(source1, path1, tokenization_service)
+        prepared2 = self.service.prepare_file(source2, path2, tokenization_service)
+
+        with patch.object(tokenization_service, 'tokenize') as tokenize_mock:
+            result = self.service.detect_shared_code_blocks(
+                source1, source2, "file1.py", "file2.py", path1, path2, tokenization_service,
+                prepared1=prepared1, prepared2=prepared2
+            )
+
+        tokenize_mock.assert_not_called()
+        self.assertEqual(expected['total_shared_blocks'], 1)
+        self.assertEqual(result, expected)
+
+    def test_detect_shared_code_blocks_with_cache_passes_cache_context(self):
+        """Test that the cache-aware detection tokenizes with the cache context of files that have one."""
+        tokenization_service = TokenizationService()
+        source1 = "def total(items):\n    result = 0\n    for item in items:\n        result += item\n    return result"
+        source2 = "def summed(values):\n    acc = 0\n    for value in values:\n        acc += value\n    return acc"
+        path1, path2 = Path("file1.py"), Path("file2.py")
+        root1 = Path("project1")
+
+        with patch.object(
+            tokenization_service, 'tokenize', wraps=tokenization_service.tokenize
+        ) as tokenize_mock:
+            result = self.service.detect_shared_code_blocks_with_cache(
+                source1, source2, "file1.py", "file2.py", path1, path2, tokenization_service,
+                submission1_id="submission-1", project1_root=root1
+            )
+
+        self.assertEqual(result['total_shared_blocks'], 1)
+        self.assertEqual(result['shared_blocks'][0]['file1_function'], 'total')
+        tokenize_mock.assert_any_call(
+            source1, path1, submission_id="submission-1", project_root_path=root1
+        )
+        tokenize_mock.assert_any_call(source2, path2)
+
 if __name__ == '__main__':
     unittest.main()
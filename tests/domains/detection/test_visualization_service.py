@@ -11,6 +11,7 @@ from app.domains.detection.visualization import VisualizationService
 class TestVisualizationService(unittest.TestCase):
     def setUp(self):
         """Set up test fixtures before each test method."""
+        VisualizationService.clear_cache()
         self.service = VisualizationService()
 
     def test_init_successful(self):
@@ -75,6 +76,82 @@ def test_func():
         self.assertIn('functions', result)
         self.assertIn('imports', result)
 
+    def test_generate_react_flow_ast_extracts_functions_once(self):
+        """Test that functions are extracted once per file and shared with detection."""
+        source1 = "def calculate(x):\n    return x * 2"
+        source2 = "def compute(y):\n    return y * 2"
+
+        with patch.object(
+            self.service.tokenization_service,
+            'extract_functions_with_positions',
+            wraps=self.service.tokenization_service.extract_functions_with_positions,
+        ) as extract_mock:
+            result = self.service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "elk")
+
+        self.assertNotIn('error', result)
+        self.assertEqual(extract_mock.call_count, 2)
+
+    def test_generate_react_flow_ast_reuses_cached_result(self):
+        """Test that an identical source pair is served from the cache as an independent copy."""
+        source1 = "def calculate(x):\n    return x * 2"
+        source2 = "def compute(y):\n    return y * 2"
+
+        first = self.service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "elk")
+        first['nodes'][0]['id'] = 'changed'
+
+        with patch.object(
+            self.service.tokenization_service,
+            'extract_functions_with_positions',
+            wraps=self.service.tokenization_service.extract_functions_with_positions,
+        ) as extract_mock:
+            second = self.service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "elk")
+            third = self.service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "dagre")
+
+        self.assertEqual(extract_mock.call_count, 2)  # only the other layout engine is generated
+        self.assertEqual(second['nodes'][0]['id'], 'file1_root')
+        self.assertEqual(third['analysis_metadata']['algorithm'], 'dagre_layered')
+
+    def test_generate_react_flow_ast_cache_is_per_tokenization_service(self):
+        """Test that services built on different tokenization services do not share cached visualizations."""
+        source1 = "def calculate(x):\n    return x * 2"
+        source2 = "def compute(y):\n    return y * 2"
+        self.service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "elk")
+
+        tokenization_service = Mock()
+        tokenization_service.extract_functions_with_positions.return_value = {}
+        other_service = VisualizationService(tokenization_service)
+
+        result = other_service.generate_react_flow_ast(source1, source2, "file1.py", "file2.py", "elk")
+
+        self.assertEqual(tokenization_service.extract_functions_with_positions.call_count, 2)
+        self.assertEqual(len(result['nodes']), 2)  # only the file root nodes, no functions from the first service
+
+    def test_find_function_similarity_returns_highest_match(self):
+        """Test that the highest scoring block matching by name or line range is used, the first one on ties."""
+        shared_blocks = [
+            {'file1_function': 'other', 'file1_start_line': 1, 'file1_end_line': 20, 'file2_function': 'x',
+             'similarity_score': 0.75},
+            {'file1_function': 'calculate', 'file1_start_line': 30, 'file1_end_line': 40, 'file2_function': 'y',
+             'similarity_score': 0.9},
+            {'file1_function': 'nested', 'file1_start_line': 5, 'file1_end_line': 8, 'file2_function': 'z',
+             'similarity_score': 0.9},
+        ]
+        block_index = self.service._index_shared_blocks(shared_blocks, 'file1')
+
+        by_name = self.service._find_function_similarity(
+            {'function_name': 'calculate', 'start_line': 6}, shared_blocks, block_index, 'file1'
+        )
+        in_range = self.service._find_function_similarity(
+            {'function_name': 'helper', 'start_line': 10}, shared_blocks, block_index, 'file1'
+        )
+        unmatched = self.service._find_function_similarity(
+            {'function_name': 'helper', 'start_line': 25}, shared_blocks, block_index, 'file1'
+        )
+
+        self.assertEqual(by_name['similarity_target'], 'function_y')
+        self.assertEqual(in_range['similarity_target'], 'function_x')
+        self.assertEqual(unmatched, {'has_similarity': False, 'similarity_score': 0})
+
 
 if __name__ == '__main__':
     unittest.main()